@@ -6,6 +6,8 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 load_dotenv(BASE_DIR / ".env")
 STORAGE_DIR = BASE_DIR / "storage"
 SQLITE_URL = f"sqlite:///{BASE_DIR / 'storage' / 'app.db'}"
+# Any SQLAlchemy URL; API and worker processes on several hosts must share the same database
+DATABASE_URL = os.getenv("DATABASE_URL", SQLITE_URL)
 
 # For production, set FFMPEG_BIN in your environment if it's not in PATH
 FFMPEG_BIN = os.environ.get("FFMPEG_BIN", "ffmpeg")
@@ -36,5 +38,118 @@ HAILUO_TIMEOUT = float(os.environ.get("HAILUO_TIMEOUT", "300"))
 HAILUO_POLL_INTERVAL = float(os.environ.get("HAILUO_POLL_INTERVAL", "3"))
 HAILUO_MAX_POLLS = int(os.environ.get("HAILUO_MAX_POLLS", "0"))
 
-# Number of worker threads to run for background jobs
+# Number of worker threads to run for background jobs. They run the ffmpeg-bound stages;
+# network-bound stages (R2 uploads, Hailuo/Higgsfield calls) run on IO_POOL_SIZE IO threads.
 WORKER_THREADS = int(os.getenv("WORKER_THREADS", "1"))
+IO_POOL_SIZE = int(os.getenv("IO_POOL_SIZE", "32"))
+# Hailuo polls block for up to HAILUO_TIMEOUT each, so they get their own HAILUO_POLL_THREADS
+# threads instead of competing with the IO stages above
+HAILUO_POLL_THREADS = int(os.getenv("HAILUO_POLL_THREADS", "8"))
+
+# Run the job workers inside the API process. Set to false when workers run separately
+# (python -m app.worker), so API processes only enqueue.
+EMBEDDED_WORKER = os.getenv("EMBEDDED_WORKER", "true").lower() in ("1", "true", "yes")
+# On SIGTERM a standalone worker stops its ffmpeg processes and hands their jobs back, then
+# waits up to WORKER_SHUTDOWN_TIMEOUT seconds for network stages that can't be interrupted.
+WORKER_SHUTDOWN_TIMEOUT = float(os.getenv("WORKER_SHUTDOWN_TIMEOUT", "20"))
+
+# Durable job queue: a claimed job is leased for JOB_LEASE_SECONDS and the lease is renewed
+# while it runs; if the worker dies the job is claimed again once the lease expires, and
+# given up after JOB_MAX_ATTEMPTS claims. Idle workers check for work every JOB_POLL_INTERVAL seconds.
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+
+# Priority lanes: queued jobs run highest JOB_PRIORITIES first, overridable per job type with
+# e.g. JOB_PRIORITIES="preview-render=1000,proxy=5". With JOB_PRIORITY_AGING_SECONDS > 0 every
+# that many seconds of waiting counts as one priority point, so batch work is never starved;
+# 0 makes priorities strict. PREVIEW_WORKER_THREADS extra threads only take preview renders,
+# so a preview never waits for a long job that is already running.
+JOB_PRIORITIES = {
+    "preview-render": 1000,
+    "render": 20,
+    "hailuo-transition": 20,
+    "higgsfield-generate": 20,
+    "proxy": 10,
+}
+for _item in filter(None, os.getenv("JOB_PRIORITIES", "").split(",")):
+    _job_type, _priority = _item.split("=", 1)
+    JOB_PRIORITIES[_job_type.strip()] = int(_priority)
+JOB_PRIORITY_AGING_SECONDS = float(os.getenv("JOB_PRIORITY_AGING_SECONDS", "30"))
+PREVIEW_WORKER_THREADS = int(os.getenv("PREVIEW_WORKER_THREADS", "1"))
+
+# Per-project fair share: within a lane, projects take turns in proportion to PROJECT_WEIGHTS
+# (e.g. "projA=2,projB=0.5", default 1). Each queued job advances its project's virtual clock by
+# JOB_FAIR_SHARE_QUANTUM / weight seconds, so a project with a large backlog is interleaved with
+# others instead of running first. PROJECT_MAX_RUNNING caps a project's concurrently running
+# jobs, not counting previews, across all workers (0 = no cap); PROJECT_MAX_RUNNING_OVERRIDES
+# (e.g. "projA=8,projB=0") sets the cap of individual projects.
+JOB_FAIR_SHARE_QUANTUM = float(os.getenv("JOB_FAIR_SHARE_QUANTUM", "10"))
+PROJECT_WEIGHTS = {}
+for _item in filter(None, os.getenv("PROJECT_WEIGHTS", "").split(",")):
+    _project_id, _weight = _item.split("=", 1)
+    PROJECT_WEIGHTS[_project_id.strip()] = float(_weight)
+PROJECT_MAX_RUNNING = int(os.getenv("PROJECT_MAX_RUNNING", "0"))
+PROJECT_MAX_RUNNING_OVERRIDES = {}
+for _item in filter(None, os.getenv("PROJECT_MAX_RUNNING_OVERRIDES", "").split(",")):
+    _project_id, _cap = _item.split("=", 1)
+    PROJECT_MAX_RUNNING_OVERRIDES[_project_id.strip()] = int(_cap)
+
+# Per-clip segment cache for final renders. Segments are content-addressed and
+# evicted least-recently-used once the cache grows past SEGMENT_CACHE_MAX_BYTES.
+SEGMENT_CACHE_DIR = Path(os.environ.get("SEGMENT_CACHE_DIR", str(STORAGE_DIR / "cache" / "segments")))
+SEGMENT_CACHE_MAX_BYTES = int(os.environ.get("SEGMENT_CACHE_MAX_BYTES", str(20 * 1024 ** 3)))
+
+# Number of clip segments a single render encodes concurrently
+RENDER_POOL_SIZE = int(os.getenv("RENDER_POOL_SIZE", str(min(4, os.cpu_count() or 1))))
+
+# Throttle for job progress writes: a new value is stored only when at least
+# PROGRESS_UPDATE_INTERVAL seconds have passed and progress moved by PROGRESS_UPDATE_STEP points.
+PROGRESS_UPDATE_INTERVAL = float(os.getenv("PROGRESS_UPDATE_INTERVAL", "2"))
+PROGRESS_UPDATE_STEP = int(os.getenv("PROGRESS_UPDATE_STEP", "1"))
+
+# Full ffmpeg logs are streamed to gzip files here; Job.logs keeps only the last JOB_LOG_TAIL_LINES lines
+JOB_LOGS_DIR = STORAGE_DIR / "logs"
+JOB_LOG_TAIL_LINES = int(os.getenv("JOB_LOG_TAIL_LINES", "200"))
+
+# Global ffmpeg CPU budget: at most FFMPEG_MAX_PROCESSES ffmpeg processes run at once per
+# worker process, each limited to FFMPEG_THREADS threads. Defaults are sized from the core count.
+CPU_CORES = int(os.getenv("CPU_CORES", str(os.cpu_count() or 1)))
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", str(max(1, min(4, CPU_CORES)))))
+FFMPEG_MAX_PROCESSES = int(os.getenv("FFMPEG_MAX_PROCESSES", str(max(1, CPU_CORES // FFMPEG_THREADS))))
+
+# Preview renders are written as HLS ("hls") so playback can start while ffmpeg runs,
+# or as a single MP4 ("mp4"). PREVIEW_HLS_SEGMENT_SECONDS sets the segment length.
+PREVIEW_FORMAT = os.getenv("PREVIEW_FORMAT", "hls")
+PREVIEW_HLS_SEGMENT_SECONDS = float(os.getenv("PREVIEW_HLS_SEGMENT_SECONDS", "1"))
+
+# Single-pass renders with more clips than RENDER_CHUNK_SIZE are rendered in chunks and
+# merged by stream copy, at most RENDER_MERGE_FANIN files per merge step.
+RENDER_CHUNK_SIZE = int(os.getenv("RENDER_CHUNK_SIZE", "32"))
+RENDER_MERGE_FANIN = int(os.getenv("RENDER_MERGE_FANIN", "64"))
+
+# Extra renditions written by proxy jobs alongside the editing proxy, from the same decode:
+# a SCRUB_PROXY_HEIGHT scrub proxy, a poster JPEG and a FILMSTRIP_FRAMES-tile sprite sheet.
+SCRUB_PROXY_HEIGHT = int(os.getenv("SCRUB_PROXY_HEIGHT", "240"))
+FILMSTRIP_FRAMES = int(os.getenv("FILMSTRIP_FRAMES", "10"))
+FILMSTRIP_TILE_WIDTH = int(os.getenv("FILMSTRIP_TILE_WIDTH", "160"))
+
+# Proxy policy: masters at most PROXY_HEIGHT pixels tall, already H.264/yuv420p and with
+# keyframes at most PROXY_MAX_KEYFRAME_INTERVAL seconds apart are used (or remuxed) as their own proxy.
+PROXY_HEIGHT = int(os.getenv("PROXY_HEIGHT", "480"))
+PROXY_MAX_KEYFRAME_INTERVAL = float(os.getenv("PROXY_MAX_KEYFRAME_INTERVAL", "2"))
+
+# Resumable uploads: chunks are written in place into a preallocated file under UPLOAD_SESSIONS_DIR.
+# Clients may pick their own chunk size up to UPLOAD_MAX_CHUNK_SIZE.
+UPLOAD_SESSIONS_DIR = STORAGE_DIR / "uploads"
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(16 * 1024 ** 2)))
+UPLOAD_MAX_CHUNK_SIZE = int(os.getenv("UPLOAD_MAX_CHUNK_SIZE", str(256 * 1024 ** 2)))
+# Unfinished sessions with no new chunk for UPLOAD_SESSION_TTL seconds are deleted with their file
+UPLOAD_SESSION_TTL = float(os.getenv("UPLOAD_SESSION_TTL", str(24 * 3600)))
+# A session finalizing for longer than UPLOAD_FINALIZE_TIMEOUT seconds (its process died) can be completed again
+UPLOAD_FINALIZE_TIMEOUT = float(os.getenv("UPLOAD_FINALIZE_TIMEOUT", "3600"))
+
+# Streaming ingest (POST /upload/stream): pipe streamable videos into ffmpeg while they upload,
+# deciding from at most INGEST_SNIFF_BYTES of the file head whether the container allows it.
+LIVE_PROXY_INGEST = os.getenv("LIVE_PROXY_INGEST", "true").lower() in ("1", "true", "yes")
+INGEST_SNIFF_BYTES = int(os.getenv("INGEST_SNIFF_BYTES", str(1024 * 1024)))
@@ -0,0 +1,119 @@
+import logging
+import subprocess
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Iterator, List
+
+from .config import FFMPEG_MAX_PROCESSES, FFMPEG_THREADS
+
+logger = logging.getLogger(__name__)
+
+
+class CpuBudget:
+    """
+    Process-wide limit on concurrent ffmpeg invocations.
+
+    Every ffmpeg call takes a slot before it starts and is told how many threads it may use,
+    so proxies, frame grabs and renders running side by side never add up to more threads
+    than the host has cores.
+    """
+
+    def __init__(self, max_processes: int, threads_per_process: int):
+        self.max_processes = max(1, max_processes)
+        self.threads_per_process = max(1, threads_per_process)
+        self._slots = threading.BoundedSemaphore(self.max_processes)
+        self._lock = threading.Lock()
+        self._active = 0
+        self._processes = weakref.WeakSet()
+        self._closed = False
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def acquire(self, blocking: bool = True) -> bool:
+        """
+        Takes a slot; with ``blocking=False`` returns False instead of waiting for one.
+
+        Raises RuntimeError once the budget is closed, so no new ffmpeg starts during shutdown.
+        """
+        if not self._slots.acquire(blocking):
+            return False
+        with self._lock:
+            if self._closed:
+                self._slots.release()
+                raise RuntimeError("ffmpeg is not started while the worker shuts down")
+            self._active += 1
+        return True
+
+    def release(self):
+        with self._lock:
+            self._active -= 1
+        self._slots.release()
+
+    def popen(self, command: List[str], **kwargs) -> subprocess.Popen:
+        """Starts an ffmpeg process (inside a slot the caller holds) that ``terminate_all`` can stop."""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("ffmpeg is not started while the worker shuts down")
+            process = subprocess.Popen(command, **kwargs)
+            self._processes.add(process)
+        return process
+
+    def terminate_all(self, timeout: float = 10.0):
+        """Closes the budget and stops every running ffmpeg, so its job can be handed to another worker."""
+        with self._lock:
+            self._closed = True
+            processes = [process for process in self._processes if process.poll() is None]
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        if processes:
+            logger.info(f"Stopped {len(processes)} running ffmpeg processes")
+
+    @contextmanager
+    def slot(self) -> Iterator[int]:
+        """Blocks until a slot is free and yields the thread count the ffmpeg call may use."""
+        self.acquire()
+        try:
+            yield self.threads_per_process
+        finally:
+            self.release()
+
+
+def with_threads(command: List[str], threads: int) -> List[str]:
+    """
+    Limits every thread pool an ffmpeg command starts to ``threads`` threads.
+
+    ``-threads`` goes in as an output option, i.e. right before the output path; commands with
+    several outputs (each written as ``-y <path>``) get it before every output, with the threads
+    split between their encoders. Decoders get ``-threads`` before each ``-i``, split between
+    the inputs, and filtergraphs get ``-filter_threads``/``-filter_complex_threads``; left
+    unset, each of these would start one thread per core.
+    """
+    outputs = {len(command) - 1} | {
+        i for i in range(1, len(command) - 1)
+        if command[i - 1] == "-y" and not command[i].startswith("-")
+    }
+    # -y is a global flag; insert ahead of it so "-y <path>" pairs stay adjacent
+    positions = {i - 1 if command[i - 1] == "-y" else i for i in outputs}
+    per_output = str(max(1, threads // len(outputs)))
+    inputs = [i for i, arg in enumerate(command) if arg == "-i"]
+    per_input = str(max(1, threads // max(1, len(inputs))))
+    result = [command[0], "-filter_threads", str(threads), "-filter_complex_threads", str(threads)]
+    for i, arg in enumerate(command[1:], start=1):
+        if i in positions:
+            result.extend(["-threads", per_output])
+        elif i in inputs:
+            result.extend(["-threads", per_input])
+        result.append(arg)
+    return result
+
+
+cpu_budget = CpuBudget(FFMPEG_MAX_PROCESSES, FFMPEG_THREADS)
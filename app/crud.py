@@ -1,8 +1,11 @@
 import json
 import uuid
+from datetime import datetime
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from typing import Optional
-from . import models, schemas
+from . import media, models, schemas
 
 
 DEFAULT_PROJECT_NAME = "Default Project"
@@ -40,6 +43,7 @@ def create_asset(
     duration: Optional[float] = None,
     frame_rate: Optional[float] = None,
     metadata: Optional[dict] = None,
+    content_hash: Optional[str] = None,
 ):
     project_id = _ensure_project(db, project_id)
     aid = uuid.uuid4().hex
@@ -51,22 +55,184 @@ def create_asset(
         asset_type=asset_type,
         duration=duration,
         frame_rate=frame_rate,
+        content_hash=content_hash,
     )
     if metadata is not None:
-        asset.metadata_json = json.dumps(metadata)
+        media.apply_to_asset(asset, metadata)
     db.add(asset); db.commit(); db.refresh(asset)
     return asset
 
 def get_asset(db: Session, asset_id: str):
     return db.query(models.Asset).get(asset_id)
 
-def create_job(db: Session, type: str, payload: dict, project_id: str = None):
+# Files a proxy job derives from a master; shared by every asset with the same content hash
+DERIVED_FIELDS = ("proxy_path", "scrub_proxy_path", "poster_path", "filmstrip_path")
+
+
+def acquire_media_blob(db: Session, content_hash: str, master_path: str, size: Optional[int] = None) -> str:
+    """
+    Takes a reference on the stored master for ``content_hash`` and returns its path.
+
+    The first upload of some content registers ``master_path`` as the shared master; later
+    uploads get the existing path back and can drop their own copy.
+    """
+    updated = (
+        db.query(models.MediaBlob)
+        .filter(models.MediaBlob.content_hash == content_hash)
+        .update({models.MediaBlob.ref_count: models.MediaBlob.ref_count + 1}, synchronize_session=False)
+    )
+    if updated:
+        blob = db.get(models.MediaBlob, content_hash, populate_existing=True)
+        db.commit()
+        return blob.master_path
+    db.add(models.MediaBlob(content_hash=content_hash, master_path=str(master_path), size=size, ref_count=1))
+    try:
+        db.commit()
+    except IntegrityError:
+        # Another upload of the same content registered it first
+        db.rollback()
+        return acquire_media_blob(db, content_hash, master_path, size)
+    return str(master_path)
+
+
+def release_media_blob(db: Session, content_hash: str) -> Optional[str]:
+    """Drops a reference; returns the master path when it was the last one, so its files can go."""
+    db.query(models.MediaBlob).filter(models.MediaBlob.content_hash == content_hash).update(
+        {models.MediaBlob.ref_count: models.MediaBlob.ref_count - 1}, synchronize_session=False
+    )
+    blob = db.get(models.MediaBlob, content_hash, populate_existing=True)
+    master_path = blob.master_path if blob else None
+    deleted = (
+        db.query(models.MediaBlob)
+        .filter(models.MediaBlob.content_hash == content_hash, models.MediaBlob.ref_count <= 0)
+        .delete(synchronize_session=False)
+    )
+    db.commit()
+    return master_path if deleted else None
+
+
+def find_processed_asset(db: Session, content_hash: str):
+    """An asset with this content whose proxy has already been generated, if any."""
+    return (
+        db.query(models.Asset)
+        .filter(models.Asset.content_hash == content_hash, models.Asset.proxy_path.isnot(None))
+        .first()
+    )
+
+
+def _live_job_ids():
+    return select(models.Job.id).where(models.Job.status.in_(["queued", "running"]))
+
+
+def pending_blob_proxy(db: Session, content_hash: str) -> Optional[str]:
+    """The queued or running job that is deriving this content's proxy and renditions, if any."""
+    return db.scalar(
+        select(models.MediaBlob.proxy_job_id).where(
+            models.MediaBlob.content_hash == content_hash,
+            models.MediaBlob.proxy_job_id.in_(_live_job_ids()),
+        )
+    )
+
+
+def claim_blob_proxy(db: Session, content_hash: str, job_id: str) -> bool:
+    """
+    Makes ``job_id`` the one job deriving the files shared by this content.
+
+    Fails while another queued or running job holds the claim; that job shares its files with
+    every asset of the content once done (see ``share_derived_files``). Claiming again with the
+    same job succeeds, e.g. when the job is retried after its worker died.
+    """
+    blob = models.MediaBlob
+    claimed = (
+        db.query(blob)
+        .filter(
+            blob.content_hash == content_hash,
+            or_(
+                blob.proxy_job_id.is_(None),
+                blob.proxy_job_id == job_id,
+                blob.proxy_job_id.not_in(_live_job_ids()),
+            ),
+        )
+        .update({blob.proxy_job_id: job_id}, synchronize_session=False)
+    )
+    db.commit()
+    return bool(claimed)
+
+
+def release_blob_proxy(db: Session, content_hash: str, job_id: str):
+    db.query(models.MediaBlob).filter(
+        models.MediaBlob.content_hash == content_hash, models.MediaBlob.proxy_job_id == job_id
+    ).update({models.MediaBlob.proxy_job_id: None}, synchronize_session=False)
+    db.commit()
+
+
+def assets_waiting_for_proxy(db: Session, content_hash: str, exclude: list) -> list:
+    """Assets of this content still without a proxy, other than ``exclude``."""
+    return (
+        db.query(models.Asset)
+        .filter(
+            models.Asset.content_hash == content_hash,
+            models.Asset.proxy_path.is_(None),
+            models.Asset.id.not_in(exclude),
+        )
+        .all()
+    )
+
+
+def share_derived_files(db: Session, asset):
+    """Points every other asset with the same content at ``asset``'s proxy and renditions."""
+    if not asset.content_hash:
+        return
+    db.query(models.Asset).filter(
+        models.Asset.content_hash == asset.content_hash, models.Asset.id != asset.id
+    ).update({field: getattr(asset, field) for field in DERIVED_FIELDS}, synchronize_session=False)
+    db.commit()
+
+
+def delete_asset(db: Session, asset) -> list:
+    """
+    Deletes the asset row and returns the files that are no longer referenced.
+
+    Assets sharing a content hash share one master and its derived files, which are only
+    returned once the last of them is deleted.
+    """
+    files = [asset.master_path] + [getattr(asset, field) for field in DERIVED_FIELDS]
+    orphaned = True
+    if asset.content_hash:
+        orphaned = release_media_blob(db, asset.content_hash) is not None
+    db.delete(asset)
+    db.commit()
+    if not orphaned:
+        return []
+    return list(dict.fromkeys(path for path in files if path))
+
+def create_job(db: Session, type: str, payload: dict, project_id: str = None, render_hash: Optional[str] = None):
     project_id = _ensure_project(db, project_id)
     jid = "job_" + uuid.uuid4().hex[:12]
-    j = models.Job(id=jid, type=type, status="queued", payload=json.dumps(payload), project_id=project_id)
+    j = models.Job(
+        id=jid,
+        type=type,
+        status="queued",
+        payload=json.dumps(payload),
+        project_id=project_id,
+        render_hash=render_hash,
+    )
     db.add(j); db.commit(); db.refresh(j)
     return j
 
+def find_render_jobs(db: Session, render_hash: str, type: str):
+    """Render jobs with the same input hash that are still running or completed, newest first."""
+    return (
+        db.query(models.Job)
+        .filter(
+            models.Job.render_hash == render_hash,
+            models.Job.type == type,
+            models.Job.status.in_(["queued", "running", "completed"]),
+        )
+        .order_by(models.Job.created_at.desc())
+        .all()
+    )
+
 def update_job(db: Session, job_id: str, **fields):
     j = db.query(models.Job).get(job_id)
     if not j: return None
@@ -141,3 +307,88 @@ def upsert_timeline_state(db: Session, project_id: str, data: dict) -> models.Ti
     db.commit()
     db.refresh(state)
     return state
+
+
+def create_upload_session(
+    db: Session,
+    filename: str,
+    size: int,
+    chunk_size: int,
+    path: str,
+    content_type: Optional[str] = None,
+    project_id: Optional[str] = None,
+):
+    session = models.UploadSession(
+        id="upl_" + uuid.uuid4().hex,
+        project_id=project_id,
+        filename=filename,
+        content_type=content_type,
+        size=size,
+        chunk_size=chunk_size,
+        path=str(path),
+        status="open",
+    )
+    db.add(session); db.commit(); db.refresh(session)
+    return session
+
+def get_upload_session(db: Session, upload_id: str):
+    return db.get(models.UploadSession, upload_id)
+
+def record_upload_chunk(db: Session, upload_id: str, index: int, size: int):
+    """Marks a chunk as received; re-sent chunks just overwrite the record."""
+    db.merge(models.UploadChunk(upload_id=upload_id, index=index, size=size))
+    # Keeps the session from being swept as abandoned while chunks are still arriving
+    db.query(models.UploadSession).filter(models.UploadSession.id == upload_id).update(
+        {models.UploadSession.updated_at: func.now()}, synchronize_session=False
+    )
+    db.commit()
+
+def received_upload_chunks(db: Session, upload_id: str) -> list:
+    rows = (
+        db.query(models.UploadChunk.index)
+        .filter(models.UploadChunk.upload_id == upload_id)
+        .order_by(models.UploadChunk.index)
+        .all()
+    )
+    return [row[0] for row in rows]
+
+def claim_upload_session(db: Session, upload_id: str, stale_before: datetime) -> bool:
+    """
+    Atomically moves an open session to finalizing so only one finalize request proceeds.
+
+    A session still finalizing since before ``stale_before`` was left behind by a crashed
+    process and can be claimed again.
+    """
+    session = models.UploadSession
+    last_activity = func.coalesce(session.updated_at, session.created_at)
+    claimed = (
+        db.query(session)
+        .filter(
+            session.id == upload_id,
+            or_(session.status == "open", and_(session.status == "finalizing", last_activity < stale_before)),
+        )
+        .update({session.status: "finalizing", session.updated_at: func.now()}, synchronize_session=False)
+    )
+    db.commit()
+    return bool(claimed)
+
+def finish_upload_session(db: Session, upload_id: str, status: str, asset_id: Optional[str] = None):
+    """Ends finalizing: ``completed`` with the new asset, ``open`` to allow a retry, or ``failed``."""
+    db.query(models.UploadSession).filter(models.UploadSession.id == upload_id).update(
+        {models.UploadSession.status: status, models.UploadSession.asset_id: asset_id},
+        synchronize_session=False,
+    )
+    db.commit()
+
+def is_blob_master(db: Session, path: str) -> bool:
+    """Whether a stored master (and so at least one asset) uses the file at ``path``."""
+    return db.query(models.MediaBlob).filter(models.MediaBlob.master_path == str(path)).first() is not None
+
+def expired_upload_sessions(db: Session, before: datetime) -> list:
+    """Unfinished sessions with no activity since ``before``."""
+    last_activity = func.coalesce(models.UploadSession.updated_at, models.UploadSession.created_at)
+    return (
+        db.query(models.UploadSession)
+        .filter(models.UploadSession.status.in_(["open", "finalizing"]), last_activity < before)
+        .all()
+    )
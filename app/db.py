@@ -1,8 +1,23 @@
-from sqlalchemy import create_engine
+import logging
+
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, declarative_base
-from .config import SQLITE_URL
+from .config import DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+if DATABASE_URL.startswith("sqlite"):
+    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False, "timeout": 30})
 
-engine = create_engine(SQLITE_URL, connect_args={"check_same_thread": False})
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_connection, _record):
+        # WAL lets the API and worker processes read while one of them writes
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.close()
+else:
+    engine = create_engine(DATABASE_URL, pool_pre_ping=True)
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False)
 Base = declarative_base()
 
@@ -17,3 +32,25 @@ def init_db():
     # import models here to register them with metadata
     from . import models
     Base.metadata.create_all(bind=engine)
+    _add_missing_columns()
+
+
+def _add_missing_columns():
+    """create_all() never alters existing tables, so add columns and indexes introduced later."""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            missing = [column for column in table.columns if column.name not in existing]
+            for column in missing:
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+            for index in table.indexes:
+                try:
+                    with conn.begin_nested():
+                        index.create(conn, checkfirst=True)
+                except IntegrityError:
+                    # Existing rows break a unique index; the app still works, only without the guarantee
+                    logger.warning(f"Could not create unique index {index.name}: existing rows conflict")
@@ -0,0 +1,94 @@
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from pathlib import Path
+from typing import Optional
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import FileResponse
+
+from . import storage
+
+# Files whose URL always names the same bytes (content-addressed masters)
+IMMUTABLE = "public, max-age=31536000, immutable"
+# Files that can be regenerated in place (proxies, thumbnails): cache, but revalidate with the ETag
+REVALIDATE = "public, no-cache"
+
+
+def file_etag(st: os.stat_result) -> str:
+    """Strong ETag from size and mtime in ns, which change whenever the file is rewritten."""
+    return f'"{st.st_size:x}-{st.st_mtime_ns:x}"'
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    # If-None-Match uses the weak comparison: W/"x" matches "x"
+    if if_none_match.strip() == "*":
+        return True
+    candidates = (tag.strip() for tag in if_none_match.split(","))
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+def _not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # When both are sent, If-None-Match wins (RFC 9110 13.2.2)
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(mtime) <= since
+    return False
+
+
+def serve_file(
+    request: Request,
+    path,
+    *,
+    cache_control: str = REVALIDATE,
+    etag: Optional[str] = None,
+    media_type: Optional[str] = None,
+    filename: Optional[str] = None,
+) -> Response:
+    """
+    Serves a file with validators, conditional GET/HEAD and byte ranges.
+
+    ``FileResponse`` answers ``Range``/``If-Range`` requests with 206 responses (multipart for
+    several ranges) and hands the file to the server's ``pathsend`` extension when available,
+    so the editor's video element can seek without re-downloading. ``etag`` overrides the
+    stat-based validator, e.g. with a content hash.
+    """
+    path = Path(path)
+    try:
+        st = path.stat()
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail="File not found")
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="File not found")
+
+    headers = {
+        "ETag": etag or file_etag(st),
+        "Last-Modified": formatdate(st.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+    if request.method in ("GET", "HEAD") and _not_modified(request, headers["ETag"], st.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    return FileResponse(
+        path,
+        media_type=media_type or storage.guess_mime_type(path),
+        filename=filename,
+        headers=headers,
+        stat_result=st,
+    )
+
+
+def resolve_under(root: Path, relative: str) -> Path:
+    """Joins a URL path onto ``root``, refusing anything that escapes it."""
+    root = Path(root).resolve()
+    path = (root / relative).resolve()
+    if not path.is_relative_to(root) or path == root:
+        raise HTTPException(status_code=404, detail="File not found")
+    return path
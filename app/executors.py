@@ -0,0 +1,59 @@
+import asyncio
+import concurrent.futures
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Coroutine, Optional
+
+from .config import HAILUO_POLL_THREADS, IO_POOL_SIZE
+
+
+class IOExecutor:
+    """
+    Runs network-bound job stages (R2 uploads, Hailuo/Higgsfield calls, result downloads).
+
+    Blocking calls go to a large thread pool; coroutines run on one shared event loop thread
+    instead of a fresh ``asyncio.run`` per job. ffmpeg-bound stages stay on the worker threads,
+    whose ffmpeg processes are limited by the CPU budget, so waiting on the network never holds
+    a CPU slot.
+    """
+
+    def __init__(self, max_workers: int, name: str = "IO"):
+        self.max_workers = max(1, max_workers)
+        self._pool = ThreadPoolExecutor(self.max_workers, thread_name_prefix=name)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self._pending = set()
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        future = self._pool.submit(fn, *args, **kwargs)
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future):
+        with self._lock:
+            self._pending.discard(future)
+
+    def wait(self, timeout: float) -> int:
+        """Waits up to ``timeout`` for the submitted calls to finish; returns how many still run."""
+        with self._lock:
+            pending = list(self._pending)
+        _, not_done = concurrent.futures.wait(pending, timeout=timeout)
+        return len(not_done)
+
+    def run_coroutine(self, coro: Coroutine) -> Any:
+        """Runs ``coro`` on the shared event loop and waits for its result."""
+        return asyncio.run_coroutine_threadsafe(coro, self._event_loop()).result()
+
+    def _event_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, daemon=True, name="IOEventLoop").start()
+            return self._loop
+
+
+io = IOExecutor(IO_POOL_SIZE)
+# Hailuo polls hold a thread for up to HAILUO_TIMEOUT; kept apart so they can't starve the stages above
+polls = IOExecutor(HAILUO_POLL_THREADS, name="HailuoPoll")
@@ -0,0 +1,201 @@
+import hashlib
+import logging
+import subprocess
+from pathlib import Path
+from typing import Dict, Optional
+
+from . import proxy_policy, storage, tasks
+from .config import INGEST_SNIFF_BYTES
+from .cpu_budget import cpu_budget, with_threads
+
+logger = logging.getLogger(__name__)
+
+_MATROSKA_MAGIC = b"\x1a\x45\xdf\xa3"
+_TS_SYNC = 0x47
+_TS_PACKET = 188
+
+
+def is_streamable(head: bytes) -> Optional[bool]:
+    """
+    Tells from the first bytes of a file whether ffmpeg can decode it from a pipe.
+
+    Matroska/WebM and MPEG-TS always can. MP4/MOV can when the ``moov`` index comes before
+    the media data (faststart or fragmented files). Returns None while more bytes are needed
+    to decide, and False once ``INGEST_SNIFF_BYTES`` have been seen without a decision.
+    """
+    if head[:4] == _MATROSKA_MAGIC:
+        return True
+    if len(head) > _TS_PACKET * 2 and head[0] == head[_TS_PACKET] == head[_TS_PACKET * 2] == _TS_SYNC:
+        return True
+
+    # ISO BMFF: walk the top-level boxes until moov (index first) or mdat (index last)
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], "big")
+        box_type = head[offset + 4:offset + 8]
+        if not box_type.isalnum():
+            return False
+        if box_type in (b"moov", b"moof"):
+            return True
+        if box_type == b"mdat" or size == 0:
+            return False
+        if size == 1:
+            if offset + 16 > len(head):
+                break
+            size = int.from_bytes(head[offset + 8:offset + 16], "big")
+        if size < 8:
+            return False
+        offset += size
+    return None if len(head) < INGEST_SNIFF_BYTES else False
+
+
+class LiveProxy:
+    """
+    Builds a video's proxy, scrub proxy and poster from its bytes while the upload is still arriving.
+
+    Upload chunks are written to ffmpeg's stdin as they come in, so the renditions are ready
+    shortly after the last byte. The filmstrip needs the duration and is left to a follow-up
+    proxy job. Any failure only disables the live proxy; the upload itself carries on.
+    """
+
+    def __init__(self, master_path: str):
+        self.master_path = master_path
+        renditions = storage.rendition_paths(master_path)
+        self.outputs: Dict[str, str] = {
+            "proxy_path": storage.proxy_path(master_path),
+            "scrub_proxy_path": renditions["scrub_proxy_path"],
+            "poster_path": renditions["poster_path"],
+        }
+        self.process: Optional[subprocess.Popen] = None
+        self.failed = False
+
+    def start(self) -> bool:
+        """Launches ffmpeg if a CPU budget slot is free right now; the upload never waits for one."""
+        if not cpu_budget.acquire(blocking=False):
+            logger.info(f"No ffmpeg slot free for a live proxy of {self.master_path}")
+            return False
+        command = tasks.proxy_command(
+            "pipe:0",
+            self.outputs["proxy_path"],
+            scrub_path=self.outputs["scrub_proxy_path"],
+            poster_path=self.outputs["poster_path"],
+        )
+        command = with_threads(command, cpu_budget.threads_per_process)
+        try:
+            self.process = cpu_budget.popen(
+                command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+        except (OSError, RuntimeError):
+            # No ffmpeg binary or a shutdown in progress: the proxy job builds the renditions later
+            logger.exception(f"Could not start a live proxy for {self.master_path}")
+            cpu_budget.release()
+            return False
+        return True
+
+    def feed(self, data: bytes):
+        """Writes the next bytes of the upload to ffmpeg (blocks while ffmpeg catches up)."""
+        if self.failed or not self.process:
+            return
+        try:
+            self.process.stdin.write(data)
+        except (BrokenPipeError, ValueError):
+            logger.warning(f"Live proxy for {self.master_path} stopped reading input")
+            self.failed = True
+
+    def finish(self) -> Optional[Dict[str, str]]:
+        """Closes ffmpeg's input and waits for it; returns the written renditions, or None on failure."""
+        if not self.process:
+            return None
+        try:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                self.failed = True
+            returncode = self.process.wait()
+        finally:
+            cpu_budget.release()
+            self.process = None
+        if self.failed or returncode != 0:
+            logger.warning(f"Live proxy for {self.master_path} failed (exit code {returncode})")
+            self.discard()
+            return None
+        return dict(self.outputs)
+
+    def abort(self):
+        """Stops ffmpeg and removes partial output, e.g. when the upload itself fails."""
+        if self.process:
+            self.process.kill()
+            self.failed = True
+            self.finish()
+
+    def discard(self):
+        for path in self.outputs.values():
+            Path(path).unlink(missing_ok=True)
+
+
+class IngestWriter:
+    """
+    Writes a streamed upload to disk, hashing it and, for streamable video, feeding a LiveProxy.
+
+    ``write`` and ``finish`` block, so the upload route calls them from the threadpool.
+    """
+
+    def __init__(self, dest: Path, live_proxy: bool):
+        self.dest = Path(dest)
+        self.size = 0
+        self.live: Optional[LiveProxy] = None
+        self._file = open(self.dest, "wb")
+        self._hasher = hashlib.sha256()
+        # Bytes kept until is_streamable() can decide; None once decided (or not wanted)
+        self._head: Optional[bytearray] = bytearray() if live_proxy else None
+
+    @property
+    def content_hash(self) -> str:
+        return self._hasher.hexdigest()
+
+    def write(self, data: bytes):
+        self._file.write(data)
+        self._hasher.update(data)
+        self.size += len(data)
+        if self._head is not None:
+            self._head += data
+            streamable = is_streamable(bytes(self._head))
+            if streamable is None:
+                return
+            head, self._head = bytes(self._head), None
+            if not streamable or not self._needs_encode():
+                return
+            live = LiveProxy(str(self.dest))
+            if not live.start():
+                return
+            # Catch ffmpeg up on everything received so far
+            self.live, data = live, head
+        if self.live:
+            self.live.feed(data)
+
+    def _needs_encode(self) -> bool:
+        """
+        Whether the proxy policy wants a full encode, judged from the bytes written so far.
+
+        A proxy-sized H.264 master is used as its own proxy (or remuxed), so encoding one live
+        would only waste a CPU slot. The streamable head carries the stream headers, which is
+        all ``proxy_policy.decide`` needs apart from keyframe spacing.
+        """
+        self._file.flush()
+        media_info = tasks.probe_media(str(self.dest))
+        action, reason = proxy_policy.decide("video", str(self.dest), media_info)
+        if action != proxy_policy.ENCODE:
+            logger.info(f"No live proxy for {self.dest}: {reason}")
+            return False
+        return True
+
+    def finish(self) -> Optional[Dict[str, str]]:
+        """Closes the file and returns the live renditions, if they were built successfully."""
+        self._file.close()
+        return self.live.finish() if self.live else None
+
+    def abort(self):
+        self._file.close()
+        if self.live:
+            self.live.abort()
+        self.dest.unlink(missing_ok=True)
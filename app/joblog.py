@@ -0,0 +1,218 @@
+import bisect
+import collections
+import gzip
+import os
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from .config import JOB_LOGS_DIR, JOB_LOG_TAIL_LINES
+
+# Seconds between gzip sync-flushes, so readers can tail a log that is still being written
+FLUSH_INTERVAL = 1.0
+# Readers keep a decoder snapshot every CHECKPOINT_BYTES of a log, for at most MAX_INDEXES log files
+CHECKPOINT_BYTES = 1024 * 1024
+MAX_INDEXES = 256
+READ_CHUNK = 64 * 1024
+
+
+def log_path(job_id: str, attempt: int = 0) -> Path:
+    """Log file of one attempt at a job; a retried job starts a new file instead of appending."""
+    if attempt == 0:
+        return JOB_LOGS_DIR / f"{job_id}.log.gz"
+    return JOB_LOGS_DIR / f"{job_id}.{attempt}.log.gz"
+
+
+def log_paths(job_id: str) -> List[Path]:
+    """The job's log files, oldest attempt first."""
+    paths = []
+    while log_path(job_id, len(paths)).exists():
+        paths.append(log_path(job_id, len(paths)))
+    return paths
+
+
+class JobLog:
+    """
+    Bounded in-memory tail of a job's output plus the full log streamed to a gzip file.
+
+    Writes are thread-safe so parallel segment encodes can share one log.
+    """
+
+    def __init__(self, job_id: str, tail_lines: int = JOB_LOG_TAIL_LINES):
+        self.job_id = job_id
+        JOB_LOGS_DIR.mkdir(parents=True, exist_ok=True)
+        self._lines = collections.deque(maxlen=tail_lines)
+        self._lock = threading.Lock()
+        # An earlier attempt may have died mid-member; appending after that would make it unreadable
+        attempt = len(log_paths(job_id))
+        while True:
+            self.path = log_path(job_id, attempt)
+            try:
+                self._file = gzip.open(self.path, "xb")
+                break
+            except FileExistsError:
+                attempt += 1
+        self._last_flush = time.monotonic()
+
+    def write(self, line: str):
+        with self._lock:
+            self._lines.append(line)
+            if self._file.closed:
+                return
+            self._file.write(line.encode("utf-8", "replace") + b"\n")
+            now = time.monotonic()
+            if now - self._last_flush >= FLUSH_INTERVAL:
+                self._file.flush(zlib.Z_SYNC_FLUSH)
+                self._last_flush = now
+
+    def tail(self) -> str:
+        with self._lock:
+            return "\n".join(self._lines)
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+_open_logs: Dict[str, JobLog] = {}
+_open_logs_lock = threading.Lock()
+
+
+def open_log(job_id: str) -> JobLog:
+    """Returns the job's shared log, opening it on first use."""
+    with _open_logs_lock:
+        log = _open_logs.get(job_id)
+        if log is None:
+            log = _open_logs[job_id] = JobLog(job_id)
+        return log
+
+
+def close_log(job_id: str) -> Optional[str]:
+    """Closes the job's log file and returns its in-memory tail, if one was open."""
+    with _open_logs_lock:
+        log = _open_logs.pop(job_id, None)
+    if log is None:
+        return None
+    log.close()
+    return log.tail()
+
+
+class _LogIndex:
+    """
+    Decoding state of one log file: how far it has been decoded and its uncompressed size so
+    far, plus decoder snapshots every CHECKPOINT_BYTES of output so a read starts near its offset.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.position = 0
+        self.size = 0
+        self.decoder = zlib.decompressobj(wbits=31)
+        self.checkpoints = [(0, 0, self.decoder.copy())]
+
+    def update(self, fh):
+        """Decodes whatever was appended since the last call, only counting the output."""
+        for position, data, decoder in _decode(fh, self.position, self.decoder):
+            self.position, self.decoder = position, decoder
+            self.size += len(data)
+            if self.size - self.checkpoints[-1][1] >= CHECKPOINT_BYTES:
+                self.checkpoints.append((position, self.size, decoder.copy()))
+
+    def checkpoint(self, offset: int):
+        """The last snapshot at or before the uncompressed ``offset``: ``(position, size, decoder)``."""
+        index = bisect.bisect_right([size for _, size, _ in self.checkpoints], offset) - 1
+        position, size, decoder = self.checkpoints[index]
+        return position, size, decoder.copy()
+
+
+def _decode(fh, position: int, decoder):
+    """
+    Yields ``(position, data, decoder)`` per chunk read from ``position`` on, ``decoder`` being
+    the state to resume from at ``position``. Stops at the end of the file, mid-member included
+    (the data up to the last flush is yielded), or at corrupt data.
+    """
+    fh.seek(position)
+    while True:
+        chunk = fh.read(READ_CHUNK)
+        if not chunk:
+            return
+        data = bytearray()
+        try:
+            data += decoder.decompress(chunk)
+            while decoder.eof:
+                # Concatenated gzip members
+                rest = decoder.unused_data
+                decoder = zlib.decompressobj(wbits=31)
+                if not rest:
+                    break
+                data += decoder.decompress(rest)
+        except zlib.error:
+            return
+        position += len(chunk)
+        yield position, bytes(data), decoder
+
+
+_indexes: "collections.OrderedDict[Path, _LogIndex]" = collections.OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def _index_for(path: Path, fh) -> _LogIndex:
+    with _indexes_lock:
+        index = _indexes.pop(path, None)
+        if index is None or os.fstat(fh.fileno()).st_size < index.position:
+            # New, or replaced by a smaller file
+            index = _LogIndex()
+        _indexes[path] = index
+        while len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+        return index
+
+
+def read_log(job_id: str, offset: int = 0, limit: int = 256 * 1024) -> Tuple[bytes, int, int]:
+    """
+    Reads up to ``limit`` bytes of the uncompressed log starting at ``offset``.
+
+    A negative ``offset`` counts from the end, for tailing. Returns ``(data, start, size)``
+    where ``size`` is the uncompressed length available so far. The files of all attempts read
+    as one log. Works on logs that are still being written: incomplete gzip members are decoded
+    up to the last flush. Each file is decoded once (and then only its new bytes), so a read
+    costs about ``limit`` plus CHECKPOINT_BYTES, not the size of the log.
+    """
+    files = []
+    for path in log_paths(job_id):
+        try:
+            fh = open(path, "rb")
+        except FileNotFoundError:
+            continue
+        index = _index_for(path, fh)
+        with index.lock:
+            index.update(fh)
+            files.append((fh, index, index.size))
+
+    try:
+        size = sum(file_size for _, _, file_size in files)
+        start = size + offset if offset < 0 else offset
+        start = max(0, min(start, size))
+        end = min(size, start + limit)
+
+        content = bytearray()
+        file_start = 0
+        for fh, index, file_size in files:
+            file_end = file_start + file_size
+            if file_end > start and file_start < end:
+                local_start, local_end = start + len(content) - file_start, end - file_start
+                with index.lock:
+                    position, decoded, decoder = index.checkpoint(local_start)
+                for _, data, decoder in _decode(fh, position, decoder):
+                    content += data[max(0, local_start - decoded):local_end - decoded]
+                    decoded += len(data)
+                    if decoded >= local_end:
+                        break
+            file_start = file_end
+    finally:
+        for fh, _, _ in files:
+            fh.close()
+    return bytes(content), start, size
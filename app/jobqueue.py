@@ -0,0 +1,354 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Optional
+
+from sqlalchemy import and_, case, delete, func, literal, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, aliased
+
+from . import crud, models
+from .config import (
+    JOB_LEASE_SECONDS,
+    JOB_MAX_ATTEMPTS,
+    JOB_POLL_INTERVAL,
+    JOB_PRIORITIES,
+    JOB_PRIORITY_AGING_SECONDS,
+    JOB_FAIR_SHARE_QUANTUM,
+    PROJECT_WEIGHTS,
+    PROJECT_MAX_RUNNING,
+    PROJECT_MAX_RUNNING_OVERRIDES,
+)
+from .db import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Queues; a job is in at most one at a time
+JOBS = "jobs"
+HAILUO_POLL = "hailuo-poll"
+
+# Identifies this process's leases; unique across hosts and restarts
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_held = set()
+_held_lock = threading.Lock()
+_heartbeat_thread: Optional[threading.Thread] = None
+_work_events = {JOBS: threading.Event(), HAILUO_POLL: threading.Event()}
+
+
+def enqueue(job_id: str, queue: str = JOBS, delay: float = 0.0) -> bool:
+    """Adds a job to a queue. Returns False if the job is already queued (or running) somewhere."""
+    db: Session = SessionLocal()
+    try:
+        job = db.get(models.Job, job_id)
+        priority = JOB_PRIORITIES.get(job.type, 0) if job else 0
+        project_id = job.project_id if job else None
+        # A second try only happens when another process created the project's share row first
+        for _ in range(2):
+            now = time.time()
+            virtual_start = _next_virtual_start(db, project_id, now + delay)
+            db.add(
+                models.QueueEntry(
+                    job_id=job_id,
+                    queue=queue,
+                    priority=priority,
+                    project_id=project_id,
+                    available_at=now + delay,
+                    virtual_start=virtual_start,
+                    claim_rank=_claim_rank(virtual_start, priority),
+                    attempts=0,
+                    created_at=now,
+                )
+            )
+            try:
+                db.commit()
+                break
+            except IntegrityError:
+                db.rollback()
+                if db.get(models.QueueEntry, job_id) is not None:
+                    return False
+        else:
+            return False
+    finally:
+        db.close()
+    _work_events[queue].set()
+    return True
+
+
+def _next_virtual_start(db: Session, project_id: Optional[str], now: float) -> float:
+    """
+    Fair-share position of a project's next job (virtual clock scheduling).
+
+    Each job advances its project's clock by JOB_FAIR_SHARE_QUANTUM / weight, starting no earlier
+    than now, so a project that queues 200 jobs at once spreads them over 200 quanta while a
+    project queueing one job later lands right at the front. A project with nothing waiting
+    starts over at now.
+    """
+    if project_id is None:
+        return now
+    share = db.get(models.ProjectShare, project_id)
+    if share is None:
+        share = models.ProjectShare(project_id=project_id, virtual_finish=0.0)
+        db.add(share)
+    entry = models.QueueEntry
+    waiting = db.scalar(
+        select(entry.job_id)
+        .where(entry.project_id == project_id, or_(entry.lease_expires_at.is_(None), entry.lease_expires_at < now))
+        .limit(1)
+    )
+    # With no backlog, earlier bursts that ran faster than their quanta no longer count against it
+    start = max(now, share.virtual_finish or 0.0) if waiting else now
+    share.virtual_finish = start + JOB_FAIR_SHARE_QUANTUM / PROJECT_WEIGHTS.get(project_id, 1.0)
+    return start
+
+
+def _claimable(queue: str, now: float, min_priority: Optional[int] = None):
+    entry = models.QueueEntry
+    conditions = [
+        entry.queue == queue,
+        entry.available_at <= now,
+        or_(entry.lease_expires_at.is_(None), entry.lease_expires_at < now),
+    ]
+    if min_priority is not None:
+        conditions.append(entry.priority >= min_priority)
+    elif queue == JOBS and (PROJECT_MAX_RUNNING > 0 or any(cap > 0 for cap in PROJECT_MAX_RUNNING_OVERRIDES.values())):
+        # Previews (the lanes with reserved threads) are extra capacity and don't count against the cap
+        running = aliased(models.QueueEntry)
+        cap = literal(PROJECT_MAX_RUNNING)
+        if PROJECT_MAX_RUNNING_OVERRIDES:
+            cap = case(PROJECT_MAX_RUNNING_OVERRIDES, value=running.project_id, else_=PROJECT_MAX_RUNNING)
+        busy_projects = (
+            select(running.project_id)
+            .where(
+                running.queue == JOBS,
+                running.priority < JOB_PRIORITIES["preview-render"],
+                running.project_id.is_not(None),
+                running.lease_expires_at >= now,
+            )
+            .group_by(running.project_id)
+            .having(cap > 0, func.count() >= cap)
+        )
+        conditions.append(or_(entry.project_id.is_(None), entry.project_id.not_in(busy_projects)))
+    return and_(*conditions)
+
+
+def _claim_rank(virtual_start: float, priority) -> float:
+    """A job's place in the aged order: each JOB_PRIORITY_AGING_SECONDS waited is worth one priority point."""
+    return virtual_start - priority * JOB_PRIORITY_AGING_SECONDS
+
+
+def _claim_order():
+    """
+    Highest priority first, then fair share between projects (``virtual_start``).
+
+    With aging the order is the stored ``claim_rank``, so ``ix_job_queue_rank`` serves it
+    instead of every claim computing and sorting an expression over the whole queue.
+    """
+    entry = models.QueueEntry
+    if JOB_PRIORITY_AGING_SECONDS > 0:
+        return (entry.claim_rank, entry.created_at)
+    return (entry.priority.desc(), entry.virtual_start, entry.created_at)
+
+
+def claim(queue: str, min_priority: Optional[int] = None) -> Optional[str]:
+    """
+    Leases the next available job from ``queue`` and returns its id, or None when there is none.
+
+    Jobs are taken in priority order (see ``_claim_order``); ``min_priority`` restricts the claim
+    to high-priority lanes. The claim is a single ``UPDATE ... WHERE job_id = (SELECT ...)
+    RETURNING`` that re-checks the lease, so two workers can never both win the same entry. Jobs
+    whose worker died become claimable again when their lease expires; after JOB_MAX_ATTEMPTS
+    claims they are failed.
+    """
+    entry = models.QueueEntry
+    while True:
+        now = time.time()
+        claimable = _claimable(queue, now, min_priority)
+        next_id = (
+            select(entry.job_id)
+            .where(claimable)
+            .order_by(*_claim_order())
+            .limit(1)
+            .scalar_subquery()
+        )
+        stmt = (
+            update(entry)
+            .where(entry.job_id == next_id, claimable)
+            .values(lease_owner=WORKER_ID, lease_expires_at=now + JOB_LEASE_SECONDS, attempts=entry.attempts + 1)
+            .returning(entry.job_id, entry.attempts)
+        )
+        db: Session = SessionLocal()
+        try:
+            row = db.execute(stmt).first()
+            db.commit()
+            if row is None:
+                # Either the queue is empty or another worker took the entry we selected
+                if db.scalar(select(entry.job_id).where(claimable).limit(1)) is None:
+                    return None
+                continue
+            job_id, attempts = row
+            if attempts > JOB_MAX_ATTEMPTS:
+                logger.warning(f"Job {job_id} abandoned after {attempts - 1} attempts")
+                crud.update_job(
+                    db,
+                    job_id,
+                    status="failed",
+                    logs=json.dumps({"error": f"worker lost the job {attempts - 1} times"}),
+                )
+                db.execute(delete(entry).where(entry.job_id == job_id))
+                db.commit()
+                continue
+        finally:
+            db.close()
+
+        with _held_lock:
+            _held.add(job_id)
+        _ensure_heartbeat()
+        return job_id
+
+
+def complete(job_id: str):
+    """
+    Removes a finished job from its queue, unless its lease was lost meanwhile.
+
+    Never call it after ``requeue``: leases are per process, so if this process has already
+    claimed the requeued entry again, completing would delete that new claim.
+    """
+    _release(job_id, delete(models.QueueEntry))
+
+
+def requeue(job_id: str, queue: Optional[str] = None, delay: float = 0.0):
+    """
+    Hands a claimed job back, optionally to another queue, to be claimed again after ``delay``.
+
+    Used for planned hand-offs (e.g. a started Hailuo job moving to the poll queue), so the
+    attempt counter starts over.
+    """
+    available_at = time.time() + delay
+    values = {
+        "available_at": available_at,
+        "virtual_start": available_at,
+        "claim_rank": _claim_rank(available_at, models.QueueEntry.priority),
+        "lease_owner": None,
+        "lease_expires_at": None,
+        "attempts": 0,
+    }
+    if queue:
+        values["queue"] = queue
+    _release(job_id, update(models.QueueEntry).values(**values))
+    if delay <= 0:
+        _work_events[queue or JOBS].set()
+
+
+def _release(job_id: str, stmt):
+    entry = models.QueueEntry
+    with _held_lock:
+        _held.discard(job_id)
+    db: Session = SessionLocal()
+    try:
+        db.execute(stmt.where(entry.job_id == job_id, entry.lease_owner == WORKER_ID))
+        db.commit()
+    finally:
+        db.close()
+
+
+def release(job_id: str):
+    """
+    Makes a claimed job claimable again right away, e.g. when a worker shutting down stopped it.
+
+    The claim is not counted as an attempt, since the job itself did not fail.
+    """
+    entry = models.QueueEntry
+    _release(
+        job_id,
+        update(entry).values(lease_owner=None, lease_expires_at=None, attempts=entry.attempts - 1),
+    )
+    _work_events[JOBS].set()
+
+
+def wait_for_work(queue: str):
+    """Sleeps until a job is enqueued in this process or JOB_POLL_INTERVAL passes."""
+    event = _work_events[queue]
+    event.wait(JOB_POLL_INTERVAL)
+    event.clear()
+
+
+def _ensure_heartbeat():
+    global _heartbeat_thread
+    with _held_lock:
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(target=_heartbeat_loop, daemon=True, name="JobLeaseHeartbeat")
+            _heartbeat_thread.start()
+
+
+def _heartbeat_loop():
+    """Extends the leases of every job this process is running, three times per lease period."""
+    entry = models.QueueEntry
+    while True:
+        time.sleep(JOB_LEASE_SECONDS / 3)
+        with _held_lock:
+            held = list(_held)
+        if not held:
+            continue
+        db: Session = SessionLocal()
+        try:
+            renewed = db.execute(
+                update(entry)
+                .where(entry.job_id.in_(held), entry.lease_owner == WORKER_ID)
+                .values(lease_expires_at=time.time() + JOB_LEASE_SECONDS)
+                .returning(entry.job_id)
+            ).scalars().all()
+            db.commit()
+            lost = set(held) - set(renewed)
+            if lost:
+                logger.warning(f"Lost the lease on jobs {sorted(lost)}")
+        except Exception as exc:
+            db.rollback()
+            logger.warning(f"Job lease heartbeat failed: {exc}")
+        finally:
+            db.close()
+
+
+def restore_unqueued_jobs():
+    """
+    Queues pending jobs that have no queue entry, e.g. jobs created before the durable queue.
+
+    Jobs that already have an entry (including ones leased by a worker that has since died) are
+    left alone: lease expiry brings them back, so restarts never run a job twice. Entries queued
+    before ``claim_rank`` existed get theirs filled in.
+    """
+    entry = models.QueueEntry
+    db: Session = SessionLocal()
+    try:
+        position = func.coalesce(entry.virtual_start, entry.available_at)
+        db.execute(
+            update(entry)
+            .where(entry.claim_rank.is_(None))
+            .values(virtual_start=position, claim_rank=_claim_rank(position, entry.priority))
+        )
+        db.commit()
+        orphans = (
+            db.query(models.Job)
+            .outerjoin(entry, entry.job_id == models.Job.id)
+            .filter(models.Job.status.in_(["queued", "waiting", "running"]), entry.job_id.is_(None))
+            .order_by(models.Job.created_at.asc())
+            .all()
+        )
+        jobs = [(job.id, _queue_for(job)) for job in orphans]
+    finally:
+        db.close()
+    for job_id, queue in jobs:
+        enqueue(job_id, queue)
+
+
+def _queue_for(job) -> str:
+    """Hailuo transitions that already started remotely only need polling."""
+    if job.type == "hailuo-transition":
+        payload = json.loads(job.payload or "{}") or {}
+        if job.remote_job_id or payload.get("hailuo_job_set_id"):
+            return HAILUO_POLL
+    return JOBS
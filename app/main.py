@@ -2,9 +2,9 @@ import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from .db import init_db
-from .worker import start_worker_thread
-from .routers import uploads, renders, jobs, projects, transitions, assets
-from .config import STORAGE_DIR
+from .routers import uploads, renders, jobs, projects, transitions, assets, media
+from .config import STORAGE_DIR, EMBEDDED_WORKER
+from . import worker
 from fastapi.staticfiles import StaticFiles
 
 app = FastAPI(title="Video Editor Prototype")
@@ -24,7 +24,9 @@ app.include_router(jobs.router)
 app.include_router(projects.router)
 app.include_router(transitions.router)
 app.include_router(assets.router)
+app.include_router(media.router)
 
+# Frame URLs handed out before /media/frames existed
 FRAMES_DIR = STORAGE_DIR / "frames"
 app.mount("/frames", StaticFiles(directory=FRAMES_DIR, check_dir=False), name="frames")
 
@@ -33,7 +35,8 @@ def startup():
     STORAGE_DIR.mkdir(parents=True, exist_ok=True)
     FRAMES_DIR.mkdir(parents=True, exist_ok=True)
     init_db()
-    start_worker_thread()
+    if EMBEDDED_WORKER:
+        worker.start_worker_thread()
 
 @app.get("/")
 def root():
@@ -0,0 +1,61 @@
+import json
+from typing import Any, Dict
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from . import models, storage, tasks
+
+# probe_media() keys that are mirrored into typed columns on MediaProbe and Asset
+TYPED_FIELDS = (
+    "duration",
+    "frame_rate",
+    "has_audio",
+    "video_codec",
+    "audio_codec",
+    "pix_fmt",
+    "keyframe_interval",
+)
+
+
+def probe(db: Session, path: str) -> Dict[str, Any]:
+    """
+    Returns ``tasks.probe_media`` output for ``path``, running ffprobe only when the file is new
+    or its size/mtime changed since the last probe.
+    """
+    path = str(path)
+    fingerprint = storage.file_fingerprint(path)
+    row = db.get(models.MediaProbe, path)
+    if row and row.fingerprint == fingerprint and row.data:
+        return json.loads(row.data)
+
+    media_info = tasks.probe_media(path)
+    if row is None:
+        row = models.MediaProbe(path=path)
+    row.fingerprint = fingerprint
+    row.width = media_info.get("width")
+    row.height = media_info.get("height")
+    for field in TYPED_FIELDS:
+        setattr(row, field, media_info.get(field))
+    row.data = json.dumps(media_info)
+    db.add(row)
+    try:
+        db.commit()
+    except IntegrityError:
+        # Another worker probed the same file concurrently; its row is just as good.
+        db.rollback()
+    return media_info
+
+
+def apply_to_asset(asset: models.Asset, media_info: Dict[str, Any]) -> models.Asset:
+    """Copies parsed probe fields onto the asset's typed columns."""
+    if not media_info:
+        return asset
+    for field in TYPED_FIELDS:
+        setattr(asset, field, media_info.get(field))
+    if media_info.get("width") is not None:
+        asset.original_width = str(media_info["width"])
+    if media_info.get("height") is not None:
+        asset.original_height = str(media_info["height"])
+    asset.metadata_json = json.dumps(media_info)
+    return asset
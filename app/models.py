@@ -1,4 +1,4 @@
-from sqlalchemy import Column, String, Integer, Text, DateTime, ForeignKey, Float, Boolean
+from sqlalchemy import Column, String, Integer, BigInteger, Text, DateTime, ForeignKey, Float, Boolean, Index, text
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from .db import Base
@@ -39,13 +39,22 @@ class Asset(Base):
     
     # Paths (Crucial for FFmpeg)
     master_path = Column(String, nullable=False)      # Storage path to high-res master file
+    content_hash = Column(String, index=True, nullable=True)  # sha256 of the master; shared via MediaBlob
     proxy_path = Column(String, nullable=True)        # Path to low-res proxy file
+    scrub_proxy_path = Column(String, nullable=True)  # Smaller, short-GOP proxy for scrubbing
+    poster_path = Column(String, nullable=True)       # Poster frame JPEG
+    filmstrip_path = Column(String, nullable=True)    # Sprite sheet of evenly spaced thumbnails
 
     # Technical Details (Required for Editing Logic, set after FFprobe)
     duration = Column(Float, nullable=True)           # Duration in seconds (use Float for precision)
     frame_rate = Column(Float, nullable=True)         # Original FPS (e.g., 29.97)
     original_width = Column(String, nullable=True)    # Store as string if you encounter fractional resolutions
     original_height = Column(String, nullable=True)
+    has_audio = Column(Boolean, nullable=True)
+    video_codec = Column(String, nullable=True)       # ffprobe codec_name, e.g. 'h264'
+    audio_codec = Column(String, nullable=True)
+    pix_fmt = Column(String, nullable=True)
+    keyframe_interval = Column(Float, nullable=True)  # Typical seconds between keyframes
     
     # Metadata and Status
     metadata_json = Column("metadata", Text, nullable=True) # Full FFprobe output
@@ -68,10 +77,23 @@ class Job(Base):
     result_path = Column(String, nullable=True)       # path to final mp4
     logs = Column(Text, nullable=True)                # json list or plain text
     remote_job_id = Column(String, nullable=True)
+    render_hash = Column(String, index=True, nullable=True)  # Canonical hash of a render's inputs
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     project = relationship("Project", back_populates="jobs")
 
+    __table_args__ = (
+        # At most one queued or running render per input hash, across all API processes
+        Index(
+            "uq_jobs_active_render",
+            "render_hash",
+            "type",
+            unique=True,
+            sqlite_where=text("status IN ('queued', 'running')"),
+            postgresql_where=text("status IN ('queued', 'running')"),
+        ),
+    )
+
 
 class TimelineState(Base):
     __tablename__ = "timelines"
@@ -81,3 +103,98 @@ class TimelineState(Base):
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
 
     project = relationship("Project", back_populates="timeline")
+
+
+class MediaProbe(Base):
+    """Cached ffprobe result for a file on disk, invalidated when size or mtime change."""
+    __tablename__ = "media_probes"
+
+    path = Column(String, primary_key=True)
+    fingerprint = Column(String, nullable=False)      # "size:mtime_ns" from storage.file_fingerprint
+    duration = Column(Float, nullable=True)
+    frame_rate = Column(Float, nullable=True)
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+    has_audio = Column(Boolean, default=False)
+    video_codec = Column(String, nullable=True)
+    audio_codec = Column(String, nullable=True)
+    pix_fmt = Column(String, nullable=True)
+    keyframe_interval = Column(Float, nullable=True)
+    data = Column(Text, nullable=True)                # Parsed probe_media() output as JSON
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class MediaBlob(Base):
+    """A stored master shared by every Asset with the same content hash, reference counted."""
+    __tablename__ = "media_blobs"
+
+    content_hash = Column(String, primary_key=True)   # sha256 of the file contents
+    master_path = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=True)
+    ref_count = Column(Integer, nullable=False, default=0)  # Assets pointing at master_path
+    proxy_job_id = Column(String, nullable=True)      # Job currently deriving the shared proxy and renditions
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class UploadSession(Base):
+    """A resumable upload; chunks are written straight into a preallocated file at their offsets."""
+    __tablename__ = "upload_sessions"
+
+    id = Column(String, primary_key=True, index=True)
+    project_id = Column(String, ForeignKey("projects.id"), nullable=True)
+    filename = Column(String, nullable=False)
+    content_type = Column(String, nullable=True)
+    size = Column(BigInteger, nullable=False)         # Total bytes expected
+    chunk_size = Column(Integer, nullable=False)      # Every chunk but the last has this size
+    path = Column(String, nullable=False)             # Preallocated file the chunks land in
+    status = Column(String, nullable=False, default="open")  # open, finalizing, completed, failed
+    asset_id = Column(String, nullable=True)          # Set once finalized
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+    chunks = relationship("UploadChunk", cascade="all, delete-orphan")
+
+
+class UploadChunk(Base):
+    __tablename__ = "upload_chunks"
+
+    upload_id = Column(String, ForeignKey("upload_sessions.id"), primary_key=True)
+    index = Column(Integer, primary_key=True)
+    size = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class QueueEntry(Base):
+    """
+    A job waiting in, or leased from, one of the durable work queues (see jobqueue.py).
+
+    One row per job, so a job can never sit in two queues at once. Times are epoch seconds so
+    claims compare plain numbers.
+    """
+    __tablename__ = "job_queue"
+
+    job_id = Column(String, ForeignKey("jobs.id"), primary_key=True)
+    queue = Column(String, nullable=False)            # jobqueue.JOBS or jobqueue.HAILUO_POLL
+    priority = Column(Integer, nullable=False, default=0)  # JOB_PRIORITIES of the job's type; higher runs first
+    project_id = Column(String, nullable=True)        # Job's project, for fair share and concurrency caps
+    available_at = Column(Float, nullable=False)      # Not claimable before this time
+    virtual_start = Column(Float, nullable=True)      # Fair-share position among other projects' jobs
+    claim_rank = Column(Float, nullable=True)         # virtual_start aged by priority; lowest is claimed first
+    lease_owner = Column(String, nullable=True)       # Worker process holding the job
+    lease_expires_at = Column(Float, nullable=True)   # Claimable again once passed (worker died)
+    attempts = Column(Integer, nullable=False, default=0)  # Claims since the last clean hand-off
+    created_at = Column(Float, nullable=False)
+
+    __table_args__ = (
+        Index("ix_job_queue_lane", "queue", "priority", "virtual_start"),
+        Index("ix_job_queue_rank", "queue", "claim_rank"),
+        Index("ix_job_queue_project", "project_id", "lease_expires_at"),
+    )
+
+
+class ProjectShare(Base):
+    """Fair-share state of a project: the virtual time at which its queued work runs out."""
+    __tablename__ = "project_shares"
+
+    project_id = Column(String, primary_key=True)
+    virtual_finish = Column(Float, nullable=False, default=0)
@@ -0,0 +1,51 @@
+import threading
+import time
+from typing import Optional
+
+from sqlalchemy.orm import Session
+
+from . import crud
+from .config import PROGRESS_UPDATE_INTERVAL, PROGRESS_UPDATE_STEP
+from .db import SessionLocal
+
+
+class ProgressReporter:
+    """
+    Writes job progress to the database at a bounded rate.
+
+    Safe to call from several threads (segment and proxy pools); each write uses its own
+    session. Progress never moves backwards.
+    """
+
+    def __init__(self, job_id: str, interval: float = PROGRESS_UPDATE_INTERVAL, step: int = PROGRESS_UPDATE_STEP):
+        self.job_id = job_id
+        self.interval = interval
+        self.step = step
+        self._lock = threading.Lock()
+        self._last_progress = 0
+        self._last_write = 0.0
+
+    def __call__(self, progress: int, force: bool = False):
+        progress = max(0, min(100, int(progress)))
+        with self._lock:
+            if progress <= self._last_progress and not force:
+                return
+            now = time.monotonic()
+            if not force and (
+                now - self._last_write < self.interval or progress - self._last_progress < self.step
+            ):
+                return
+            self._last_progress = max(progress, self._last_progress)
+            self._last_write = now
+
+        db: Session = SessionLocal()
+        try:
+            crud.update_job(db, self.job_id, progress=progress)
+        finally:
+            db.close()
+
+    def fraction(self, value: Optional[float], scale: int = 99):
+        """Report a 0..1 fraction, scaled so completion is left to the final status update."""
+        if value is None:
+            return
+        self(int(max(0.0, min(1.0, value)) * scale))
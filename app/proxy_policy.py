@@ -0,0 +1,46 @@
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from .config import PROXY_HEIGHT, PROXY_MAX_KEYFRAME_INTERVAL
+
+# What a proxy job does for an asset
+NONE = "none"      # nothing to derive, e.g. audio
+SKIP = "skip"      # the master already works as a proxy
+REMUX = "remux"    # suitable codec in an unsuitable container: stream-copy into MP4
+ENCODE = "encode"  # full downscale and re-encode
+IMAGE = "image"    # downscaled still
+
+# Containers and codecs that preview renders seek and decode cheaply
+PROXY_CONTAINERS = {".mp4", ".m4v", ".mov"}
+PROXY_VIDEO_CODECS = {"h264"}
+
+
+def decide(asset_type: str, master_path: str, media_info: Optional[Dict[str, Any]]) -> Tuple[str, str]:
+    """
+    Picks the cheapest proxy action for a master from its ``tasks.probe_media`` output.
+
+    Returns ``(action, reason)``. Small H.264/yuv420p masters with regular keyframes are used
+    as-is (or remuxed when the container isn't MP4/MOV); everything else gets a full encode.
+    """
+    media_info = media_info or {}
+    height = media_info.get("height")
+
+    if asset_type == "audio":
+        return NONE, "audio asset"
+    if asset_type == "image":
+        if height and height <= PROXY_HEIGHT:
+            return SKIP, f"image is {height}px tall, within the {PROXY_HEIGHT}px proxy"
+        return IMAGE, "image is larger than the proxy"
+
+    if not height:
+        return ENCODE, "video dimensions unknown"
+    if height > PROXY_HEIGHT:
+        return ENCODE, f"{height}p is larger than the {PROXY_HEIGHT}p proxy"
+    if media_info.get("video_codec") not in PROXY_VIDEO_CODECS or media_info.get("pix_fmt") != "yuv420p":
+        return ENCODE, f"{media_info.get('video_codec')}/{media_info.get('pix_fmt')} needs transcoding"
+    keyframe_interval = media_info.get("keyframe_interval")
+    if keyframe_interval and keyframe_interval > PROXY_MAX_KEYFRAME_INTERVAL:
+        return ENCODE, f"keyframes every {keyframe_interval:g}s are too sparse for seeking"
+    if Path(master_path).suffix.lower() not in PROXY_CONTAINERS:
+        return REMUX, f"{Path(master_path).suffix} container, codec already suitable"
+    return SKIP, f"{height}p {media_info.get('video_codec')} master is already proxy-sized"
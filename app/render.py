@@ -1,13 +1,37 @@
+import collections
+import hashlib
+import json
 import os
+import re
+import shutil
 import subprocess
-from typing import Dict, List, Any, Tuple
+import threading
+import concurrent.futures
+from pathlib import Path
+from typing import Callable, Dict, List, Any, Optional, Tuple
 import logging
-from . import crud
+from . import crud, joblog, media, storage, tasks
+from .config import (
+    FFMPEG_BIN,
+    STORAGE_DIR,
+    RENDER_POOL_SIZE,
+    PREVIEW_FORMAT,
+    PREVIEW_HLS_SEGMENT_SECONDS,
+    RENDER_CHUNK_SIZE,
+    RENDER_MERGE_FANIN,
+)
+from .cpu_budget import cpu_budget, with_threads
+from .segment_cache import SegmentCache, segment_cache
 from sqlalchemy.orm import Session
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+RENDERS_DIR = STORAGE_DIR / "renders"
+
+# Bump when the segment command changes in a way that alters the encoded output.
+SEGMENT_FORMAT_VERSION = 1
+
 def get_asset_path(db: Session, asset_id: str, preview: bool = False) -> str:
     asset = crud.get_asset(db, asset_id)
     if not asset:
@@ -16,65 +40,294 @@ def get_asset_path(db: Session, asset_id: str, preview: bool = False) -> str:
         return asset.proxy_path
     return asset.master_path
 
-def build_ffmpeg_command(db: Session, timeline: Dict[str, Any], job_id: str, preview: bool = False) -> tuple[List[str], str]:
+def _preset_settings(output_settings: Dict[str, Any], default_filename: str) -> Dict[str, Any]:
+    return {
+        "output_filename": output_settings.get("output_filename", default_filename),
+        "resolution": output_settings.get("resolution", "1920x1080"),
+        "framerate": str(output_settings.get("framerate", "30")),
+        "video_codec": output_settings.get("video_codec", "libx264"),
+        "audio_codec": output_settings.get("audio_codec", "aac"),
+        "bitrate": output_settings.get("bitrate"),
+        "preset": "medium",
+        "fit": output_settings.get("fit") or "stretch",
+    }
+
+
+def _output_settings(timeline: Dict[str, Any], job_id: str, preview: bool) -> Dict[str, Any]:
+    output_settings = timeline.get("output_settings", {})
+    if isinstance(output_settings, list):
+        # Multi-output timeline: single-output paths use the first preset
+        output_settings = output_settings[0] if output_settings else {}
+
+    if preview:
+        return {
+            "output_filename": f"{job_id}_preview.mp4",
+            "resolution": "854x480",
+            "framerate": str(output_settings.get("framerate", "30")),
+            "video_codec": "libx264",
+            "audio_codec": "aac",
+            "bitrate": "2M",
+            "preset": "ultrafast",
+            "fit": "stretch",
+        }
+    return _preset_settings(output_settings, f"{job_id}.mp4")
+
+
+def output_presets(timeline: Dict[str, Any], job_id: str) -> List[Dict[str, Any]]:
     """
-    Builds an ffmpeg command from a timeline JSON object.
+    Returns the settings of every output a final render produces.
+
+    ``output_settings`` is either one preset or a list of presets (e.g. 1080p, 720p and a
+    vertical 9:16 cut); list entries without an ``output_filename`` get ``{job_id}_{index}.mp4``.
     """
     output_settings = timeline.get("output_settings", {})
-    
-    if preview:
-        output_filename = f"{job_id}_preview.mp4"
-        output_resolution = "854x480"
-        output_framerate = str(output_settings.get("framerate", "30"))
-        video_codec = "libx264"
-        audio_codec = "aac"
-        bitrate = "2M"
-        preset = "ultrafast"
-    else:
-        output_filename = output_settings.get("output_filename", f"{job_id}.mp4")
-        output_resolution = output_settings.get("resolution", "1920x1080")
-        output_framerate = str(output_settings.get("framerate", "30"))
-        video_codec = output_settings.get("video_codec", "libx264")
-        audio_codec = output_settings.get("audio_codec", "aac")
-        bitrate = output_settings.get("bitrate")
-        preset = "medium"
-
-    tracks = timeline.get("tracks", [])
+    if not isinstance(output_settings, list):
+        return [_output_settings(timeline, job_id, preview=False)]
+    if not output_settings:
+        raise ValueError("output_settings must contain at least one preset.")
+
+    presets = [
+        _preset_settings(preset, f"{job_id}_{index}.mp4")
+        for index, preset in enumerate(output_settings)
+    ]
+    filenames = [preset["output_filename"] for preset in presets]
+    if len(set(filenames)) != len(filenames):
+        raise ValueError("Each output preset needs a distinct output_filename.")
+    return presets
+
+
+def _scale_filter(settings: Dict[str, Any]) -> str:
+    """
+    Scales to the preset's resolution.
+
+    ``fit`` decides what happens when the aspect ratio differs from the source: ``stretch``
+    (default) scales to the exact size, ``crop`` fills the frame and crops the overflow (e.g. a
+    9:16 cut of 16:9 footage), ``pad`` letterboxes.
+    """
+    resolution = settings["resolution"]
+    fit = settings.get("fit", "stretch")
+    if fit == "stretch":
+        return f"scale={resolution}"
+    width, height = resolution.split("x")
+    if fit == "crop":
+        return f"scale={width}:{height}:force_original_aspect_ratio=increase,crop={width}:{height},setsar=1"
+    if fit == "pad":
+        return (
+            f"scale={width}:{height}:force_original_aspect_ratio=decrease,"
+            f"pad={width}:{height}:(ow-iw)/2:(oh-ih)/2,setsar=1"
+        )
+    raise ValueError(f"Unsupported fit mode: {fit}")
+
+
+def _video_clips(timeline: Dict[str, Any]) -> List[Dict[str, Any]]:
     video_clips = []
-    for track in tracks:
+    for track in timeline.get("tracks", []):
         if track.get("type") == "video":
             video_clips.extend(track.get("clips", []))
+    return video_clips
+
+
+# Bump when rendering changes in a way that should invalidate memoized renders.
+RENDER_HASH_VERSION = 1
+
+
+def render_hash(db: Session, timeline: Dict[str, Any], preview: bool) -> Optional[str]:
+    """
+    Canonical hash of everything a render's output depends on.
+
+    Covers the timeline JSON (including output settings), the fingerprint of every source
+    file the render would read and the preview output format. Returns None when a source is
+    missing, in which case the render is not memoized.
+    """
+    sources = {}
+    for clip in _video_clips(timeline):
+        try:
+            path = get_asset_path(db, clip["asset_id"], preview=preview)
+            sources[clip["asset_id"]] = [path, storage.file_fingerprint(path)]
+        except (ValueError, OSError):
+            return None
+    canonical = json.dumps(
+        {
+            "version": RENDER_HASH_VERSION,
+            "preview": preview,
+            "preview_format": PREVIEW_FORMAT if preview else None,
+            "timeline": timeline,
+            "sources": sources,
+        },
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def window_timeline(timeline: Dict[str, Any], start: float, end: float) -> Dict[str, Any]:
+    """
+    Returns a copy of the timeline restricted to ``[start, end]`` in timeline time.
+
+    Clips outside the window are dropped and the rest have their in/out points pulled in so
+    only the overlapping part is rendered.
+    """
+    windowed = dict(timeline)
+    tracks = []
+    for track in timeline.get("tracks", []):
+        clips = []
+        for clip in track.get("clips", []):
+            clip_start = max(start, clip["track_start"])
+            clip_end = min(end, clip["track_end"])
+            if clip_end <= clip_start:
+                continue
+            trimmed = dict(clip)
+            trimmed["source_in"] = clip["source_in"] + (clip_start - clip["track_start"])
+            trimmed["source_out"] = min(clip["source_out"], clip["source_in"] + (clip_end - clip["track_start"]))
+            trimmed["track_start"] = clip_start - start
+            trimmed["track_end"] = clip_end - start
+            clips.append(trimmed)
+        tracks.append({**track, "clips": clips})
+    windowed["tracks"] = tracks
+
+    if not _video_clips(windowed):
+        raise ValueError(f"No video clips intersect the window [{start}, {end}].")
+
+    def _window_output(output_settings: Dict[str, Any]) -> Dict[str, Any]:
+        output_settings = dict(output_settings or {})
+        if output_settings.get("output_filename"):
+            # Keep windowed renders from overwriting the full render's file
+            name = Path(output_settings["output_filename"])
+            output_settings["output_filename"] = f"{name.stem}_{start:g}-{end:g}{name.suffix}"
+        return output_settings
+
+    output_settings = timeline.get("output_settings")
+    if isinstance(output_settings, list):
+        windowed["output_settings"] = [_window_output(preset) for preset in output_settings]
+    else:
+        windowed["output_settings"] = _window_output(output_settings)
+    windowed["render_window"] = [start, end]
+    return windowed
+
+
+def timeline_duration(timeline: Dict[str, Any]) -> float:
+    """Length of the rendered output in seconds (clips are concatenated back to back)."""
+    return sum(max(clip["source_out"] - clip["source_in"], 0.0) for clip in _video_clips(timeline))
 
+
+def seek_input_args(asset_path: str, source_in: float, duration: float) -> List[str]:
+    """
+    Input options that open ``asset_path`` at ``source_in`` for ``duration`` seconds.
+
+    Placed before ``-i`` ffmpeg seeks the demuxer to the nearest preceding keyframe and, with
+    accurate seeking, drops the decoded frames before ``source_in``. Decode cost therefore scales
+    with the clip length rather than with its position in the source.
+    """
+    return ["-accurate_seek", "-ss", str(source_in), "-t", str(duration), "-i", asset_path]
+
+
+def work_dir(job_id: str) -> Path:
+    """Scratch space for a render's intermediates (concat lists, smart-cut parts, chunks, merges)."""
+    return Path(f"/tmp/{job_id}")
+
+
+def remove_work_dir(job_id: str):
+    """Deletes a job's render intermediates; run once the job has finished, failed or stopped."""
+    shutil.rmtree(work_dir(job_id), ignore_errors=True)
+
+
+def _output_path(output_filename: str) -> str:
+    RENDERS_DIR.mkdir(parents=True, exist_ok=True)
+    return str(RENDERS_DIR / output_filename)
+
+
+HLS_PLAYLIST_NAME = "index.m3u8"
+
+
+def preview_hls_dir(job_id: str) -> Path:
+    return RENDERS_DIR / f"{job_id}_preview"
+
+
+def _hls_output_args(hls_dir: Path, force_keyframes: bool = True) -> List[str]:
+    """
+    Output options for a live ("event") HLS playlist.
+
+    Keyframes are forced on segment boundaries so the first segment is playable after
+    PREVIEW_HLS_SEGMENT_SECONDS, and temp_file keeps players from seeing partial files.
+    Stream-copied output can't force keyframes; segments then follow the source GOPs.
+    """
+    hls_dir.mkdir(parents=True, exist_ok=True)
+    segment_seconds = PREVIEW_HLS_SEGMENT_SECONDS
+    args = []
+    if force_keyframes:
+        args += ["-force_key_frames", f"expr:gte(t,n_forced*{segment_seconds})"]
+    return args + [
+        "-f", "hls",
+        "-hls_time", str(segment_seconds),
+        "-hls_playlist_type", "event",
+        "-hls_flags", "independent_segments+temp_file",
+        "-hls_segment_filename", str(hls_dir / "segment_%05d.ts"),
+    ]
+
+
+def _faststart_args(output_path: str) -> List[str]:
+    """Moves the moov atom to the front of MP4/MOV outputs so playback can begin immediately."""
+    if Path(output_path).suffix.lower() in (".mp4", ".mov", ".m4v"):
+        return ["-movflags", "+faststart"]
+    return []
+
+
+def build_ffmpeg_command(
+    db: Session,
+    timeline: Dict[str, Any],
+    job_id: str,
+    preview: bool = False,
+    *,
+    intermediate_path: Optional[str] = None,
+    with_audio: Optional[bool] = None,
+) -> tuple[List[str], str]:
+    """
+    Builds an ffmpeg command from a timeline JSON object.
+
+    With ``intermediate_path`` the result is a plain MP4 chunk meant to be stream-copied into
+    a larger render; ``with_audio`` then forces an audio track on or off so every chunk ends up
+    with the same stream layout.
+    """
+    settings = _output_settings(timeline, job_id, preview)
+    output_filename = settings["output_filename"]
+    output_framerate = settings["framerate"]
+    video_codec = settings["video_codec"]
+    audio_codec = settings["audio_codec"]
+    bitrate = settings["bitrate"]
+    preset = settings["preset"]
+
+    video_clips = _video_clips(timeline)
     if not video_clips:
         raise ValueError("No video clips found in the timeline.")
 
     # For this implementation, we'll assume a simple concatenation.
     # A real-world scenario would require complex filtergraphs for transitions and effects.
     
-    temp_dir = f"/tmp/{job_id}"
+    temp_dir = work_dir(job_id)
     os.makedirs(temp_dir, exist_ok=True)
     
-    # Generate trimmed clips with proper in/out points
+    # Open each clip at its in point with proper in/out points
     filter_complex = []
     inputs = []
-    has_audio = False
+    asset_paths = [get_asset_path(db, clip['asset_id'], preview=preview) for clip in video_clips]
+    # Probe results are cached per file, so this doesn't shell out for known assets
+    clip_audio = [bool(media.probe(db, path).get("has_audio")) for path in asset_paths]
+    has_audio = any(clip_audio) if with_audio is None else with_audio
 
     for i, clip in enumerate(video_clips):
-        asset_path = get_asset_path(db, clip['asset_id'], preview=preview)
-        # Check if the input file has audio
-        probe_cmd = ["ffprobe", "-i", asset_path, "-show_streams", "-select_streams", "a", "-v", "0", "-f", "null", "-"]
-        result = subprocess.run(probe_cmd, capture_output=True, text=True)
-        if result.stdout or result.stderr:
-            has_audio = True
-
-        inputs.extend(['-i', asset_path])
+        asset_path = asset_paths[i]
         # Calculate clip duration from source points
         clip_duration = clip['source_out'] - clip['source_in']
+        # Seek on the input so ffmpeg only decodes the clip's own range
+        inputs.extend(seek_input_args(asset_path, clip['source_in'], clip_duration))
         
-        # Add scaling, trim filter, and setpts to correct timestamps for each clip
-        filter_complex.append(f'[{i}:v]scale={output_resolution},trim=start={clip["source_in"]}:duration={clip_duration},setpts=PTS-STARTPTS[v{i}]')
-        if has_audio:
-            filter_complex.append(f'[{i}:a]atrim=start={clip["source_in"]}:duration={clip_duration},asetpts=PTS-STARTPTS[a{i}]')
+        # Add scaling and setpts to correct timestamps for each clip
+        filter_complex.append(f'[{i}:v]setpts=PTS-STARTPTS,{_scale_filter(settings)},format=yuv420p[v{i}]')
+        if has_audio and clip_audio[i]:
+            filter_complex.append(f'[{i}:a]asetpts=PTS-STARTPTS,aresample=48000,aformat=channel_layouts=stereo[a{i}]')
+        elif has_audio:
+            # Silent clip in a timeline with audio: pad with silence so the audio concat lines up
+            filter_complex.append(f'anullsrc=channel_layout=stereo:sample_rate=48000,atrim=duration={clip_duration}[a{i}]')
 
     # Concatenate all processed clips
     video_chain = ''.join(f'[v{i}]' for i in range(len(video_clips)))
@@ -87,11 +340,9 @@ def build_ffmpeg_command(db: Session, timeline: Dict[str, Any], job_id: str, pre
     # Scaling is now done per-clip, so remove the final scaling filter
     # filter_complex.append(f'[vcont]scale={output_resolution}[vout]')
 
-    output_dir = "storage/renders"
-    os.makedirs(output_dir, exist_ok=True)
-    output_path = os.path.join(output_dir, output_filename)
+    output_path = _output_path(output_filename)
 
-    ffmpeg_command = ["ffmpeg"]
+    ffmpeg_command = [FFMPEG_BIN]
     ffmpeg_command.extend(inputs)
     
     # Add filter complex
@@ -115,30 +366,645 @@ def build_ffmpeg_command(db: Session, timeline: Dict[str, Any], job_id: str, pre
     
     if bitrate:
         ffmpeg_command.extend(["-b:v", bitrate])
+
+    if intermediate_path:
+        output_path = intermediate_path
+        ffmpeg_command.extend(["-video_track_timescale", "90000"])
+    elif preview and PREVIEW_FORMAT == "hls":
+        output_path = str(preview_hls_dir(job_id) / HLS_PLAYLIST_NAME)
+        ffmpeg_command.extend(_hls_output_args(preview_hls_dir(job_id)))
+    else:
+        ffmpeg_command.extend(_faststart_args(output_path))
     
     ffmpeg_command.extend(["-y", output_path])
 
     return ffmpeg_command, output_path
 
-def run_ffmpeg_render(command: List[str], job_id: str):
-    """Executes the ffmpeg command and logs the output."""
-    logger.info(f"Starting ffmpeg render for job {job_id}: {' '.join(command)}")
-    
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+def _segment_spec(clip: Dict[str, Any], asset_path: str, settings: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "version": SEGMENT_FORMAT_VERSION,
+        "asset_id": clip["asset_id"],
+        "fingerprint": storage.file_fingerprint(asset_path),
+        "source_in": float(clip["source_in"]),
+        "source_out": float(clip["source_out"]),
+        "resolution": settings["resolution"],
+        "framerate": settings["framerate"],
+        "video_codec": settings["video_codec"],
+        "audio_codec": settings["audio_codec"],
+        "bitrate": settings["bitrate"],
+        "preset": settings["preset"],
+        "fit": settings["fit"],
+    }
+
+
+def build_segment_command(
+    asset_path: str,
+    clip: Dict[str, Any],
+    settings: Dict[str, Any],
+    has_audio: bool,
+    output_path: str,
+    codec_args: Optional[List[str]] = None,
+) -> List[str]:
+    """
+    Builds an ffmpeg command that renders a single clip into a self-contained segment.
+
+    Every segment gets the same stream layout (video plus 48kHz stereo audio, silent when the
+    source has none) so the segments can later be joined with the concat demuxer and ``-c copy``.
+    """
+    return build_multi_segment_command(asset_path, clip, [(settings, output_path)], has_audio, codec_args)
+
+
+def build_multi_segment_command(
+    asset_path: str,
+    clip: Dict[str, Any],
+    outputs: List[Tuple[Dict[str, Any], str]],
+    has_audio: bool,
+    codec_args: Optional[List[str]] = None,
+) -> List[str]:
+    """
+    Builds an ffmpeg command that renders one clip into a segment per ``(settings, path)`` output.
+
+    The clip is decoded once and split into one scale/encode branch per output, so rendering
+    several deliverables costs a single decode. Segments use the layout described in
+    ``build_segment_command``.
+    """
+    clip_duration = clip["source_out"] - clip["source_in"]
+    count = len(outputs)
+    command = [FFMPEG_BIN, *seek_input_args(asset_path, clip["source_in"], clip_duration)]
+    filter_complex = [
+        f'[0:v]setpts=PTS-STARTPTS,split={count}' + ''.join(f'[vsrc{i}]' for i in range(count))
+    ]
+    for i, (settings, _) in enumerate(outputs):
+        filter_complex.append(
+            f'[vsrc{i}]{_scale_filter(settings)},fps={settings["framerate"]},format=yuv420p[vout{i}]'
+        )
+    if has_audio:
+        filter_complex.append(
+            f'[0:a]asetpts=PTS-STARTPTS,'
+            f'aresample=48000,aformat=channel_layouts=stereo,asplit={count}'
+            + ''.join(f'[aout{i}]' for i in range(count))
+        )
+        audio_maps = [f"[aout{i}]" for i in range(count)]
+    else:
+        command.extend(["-f", "lavfi", "-t", str(clip_duration), "-i", "anullsrc=channel_layout=stereo:sample_rate=48000"])
+        audio_maps = ["1:a"] * count
+
+    command.extend(["-filter_complex", ";".join(filter_complex)])
+    for i, (settings, output_path) in enumerate(outputs):
+        command.extend([
+            "-map", f"[vout{i}]",
+            "-map", audio_maps[i],
+            "-c:v", settings["video_codec"],
+            "-preset", settings["preset"],
+        ])
+        if settings["bitrate"]:
+            command.extend(["-b:v", settings["bitrate"]])
+        if codec_args:
+            command.extend(codec_args)
+        command.extend([
+            "-c:a", settings["audio_codec"],
+            "-ar", "48000",
+            "-ac", "2",
+            "-t", str(clip_duration),
+            "-video_track_timescale", "90000",
+            "-y", output_path,
+        ])
+    return command
+
+
+def build_concat_command(
+    segment_paths: List[Path],
+    list_path: str,
+    output_path: str,
+    faststart: bool = False,
+    output_args: Optional[List[str]] = None,
+) -> List[str]:
+    """Builds an ffmpeg command that joins pre-rendered segments without re-encoding."""
+    with open(list_path, "w") as fh:
+        for segment in segment_paths:
+            escaped = str(segment).replace("'", "'\\''")
+            fh.write(f"file '{escaped}'\n")
+    command = [FFMPEG_BIN, "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy"]
+    if faststart:
+        command.extend(_faststart_args(output_path))
+    if output_args:
+        command.extend(output_args)
+    return command + ["-y", output_path]
+
+
+# Encoder names mapped to the codec_name ffprobe reports for their output.
+_ENCODER_CODECS = {
+    "libx264": "h264",
+    "h264": "h264",
+    "libx265": "hevc",
+    "hevc": "hevc",
+}
+
+
+def _smart_cut_plan(
+    asset_path: str,
+    clip: Dict[str, Any],
+    settings: Dict[str, Any],
+    media_info: Dict[str, Any],
+) -> Optional[Tuple[List[Tuple[str, float, float]], Dict[str, Any]]]:
+    """
+    Splits a clip into stream-copy and re-encode parts when the source already matches the output.
+
+    Returns ``(parts, video_stream)`` where each part is ``("copy" | "encode", start, end)`` in
+    source time, or None when the clip has to be fully re-encoded. Only the GOPs before the
+    first and after the last keyframe inside the clip are re-encoded.
+    """
+    if settings["bitrate"]:
+        return None
+    streams = media_info.get("streams") or []
+    video = next((st for st in streams if st.get("codec_type") == "video"), None)
+    if not video or not media_info.get("frame_rate"):
+        return None
+    if _ENCODER_CODECS.get(settings["video_codec"]) != media_info.get("video_codec"):
+        return None
+    if f'{media_info.get("width")}x{media_info.get("height")}' != settings["resolution"]:
+        return None
+    if abs(media_info["frame_rate"] - float(settings["framerate"])) > 0.01:
+        return None
+    if media_info.get("pix_fmt") != "yuv420p":
+        return None
+
+    source_in = float(clip["source_in"])
+    source_out = float(clip["source_out"])
+    tolerance = 0.5 / media_info["frame_rate"]
+    keyframes = [
+        t for t in tasks.probe_keyframes(asset_path, source_in, source_out)
+        if source_in - tolerance <= t <= source_out + tolerance
+    ]
+    if not keyframes:
+        return None
+
+    first_key = keyframes[0]
+    ends_at_eof = media_info.get("duration") is not None and source_out >= media_info["duration"] - tolerance
+    last_key = keyframes[-1]
+    if abs(last_key - source_out) <= tolerance or ends_at_eof:
+        last_key = source_out
+    if last_key - first_key <= tolerance:
+        return None
+
+    parts = []
+    if first_key - source_in > tolerance:
+        parts.append(("encode", source_in, first_key))
+    parts.append(("copy", first_key, last_key))
+    if source_out - last_key > tolerance:
+        parts.append(("encode", last_key, source_out))
+    return parts, video
+
+
+def _matching_codec_args(video_stream: Dict[str, Any]) -> List[str]:
+    """Encoder options that keep re-encoded boundary GOPs compatible with copied packets."""
+    if video_stream.get("codec_name") != "h264":
+        return []
+    args = []
+    profile = (video_stream.get("profile") or "").lower().replace("constrained ", "")
+    if profile in {"baseline", "main", "high"}:
+        args += ["-profile:v", profile]
+    level = video_stream.get("level")
+    if isinstance(level, int) and level > 0:
+        args += ["-level", f"{level / 10:.1f}"]
+    return args
+
+
+def build_copy_part_command(asset_path: str, start: float, end: float, settings: Dict[str, Any], has_audio: bool, output_path: str) -> List[str]:
+    """Builds an ffmpeg command that copies video packets between two keyframe-aligned points."""
+    duration = end - start
+    command = [FFMPEG_BIN, "-ss", str(start), "-i", asset_path]
+    if has_audio:
+        audio_map = "0:a:0"
+    else:
+        command.extend(["-f", "lavfi", "-t", str(duration), "-i", "anullsrc=channel_layout=stereo:sample_rate=48000"])
+        audio_map = "1:a"
+    command.extend([
+        "-t", str(duration),
+        "-map", "0:v:0",
+        "-map", audio_map,
+        "-c:v", "copy",
+        "-c:a", settings["audio_codec"],
+        "-ar", "48000",
+        "-ac", "2",
+        "-avoid_negative_ts", "make_zero",
+        "-video_track_timescale", "90000",
+        "-y", output_path,
+    ])
+    return command
+
+
+def _render_smart_cut(
+    asset_path: str,
+    parts: List[Tuple[str, float, float]],
+    video_stream: Dict[str, Any],
+    settings: Dict[str, Any],
+    has_audio: bool,
+    output_path: str,
+    job_id: str,
+    on_progress: Optional[Callable[[float], None]] = None,
+) -> Optional[str]:
+    """
+    Renders the parts of a smart cut and joins them into ``output_path`` by stream copy.
+
+    The MP4 muxer keeps only the first part's SPS/PPS, and matching profile and level does not
+    make the encoder's parameter sets equal to the camera's, so copied packets could be decoded
+    with the wrong ones. Returns None, without writing ``output_path``, when the parts' extradata
+    differ; the caller then re-encodes the whole clip.
+    """
+    parts_dir = work_dir(job_id) / f"parts_{Path(output_path).stem}"
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        codec_args = _matching_codec_args(video_stream)
+        total = sum(end - start for _, start, end in parts) or 1.0
+        done = 0.0
+        logs = ""
+        part_paths = []
+        for index, (mode, start, end) in enumerate(parts):
+            part_path = parts_dir / f"{index}.mp4"
+            part_progress = None
+            if on_progress:
+                part_progress = lambda seconds, done=done, length=end - start: on_progress(
+                    (done + min(seconds, length)) / total
+                )
+            if mode == "copy":
+                command = build_copy_part_command(asset_path, start, end, settings, has_audio, str(part_path))
+            else:
+                part_clip = {"source_in": start, "source_out": end}
+                command = build_segment_command(asset_path, part_clip, settings, has_audio, str(part_path), codec_args)
+            logs = run_ffmpeg_render(command, job_id, part_progress)
+            part_paths.append(part_path)
+            done += end - start
+
+        if len(part_paths) == 1:
+            os.replace(part_paths[0], output_path)
+        elif len({tasks.probe_extradata_hash(str(path)) for path in part_paths} - {None}) != 1:
+            logger.info(f"Smart cut for job {job_id}: parts have different parameter sets, re-encoding")
+            return None
+        else:
+            command = build_concat_command(part_paths, str(parts_dir / "parts.txt"), output_path)
+            logs = run_ffmpeg_render(command, job_id)
+        return logs
+    finally:
+        # Parts are joined into output_path (or dropped); free the space before the next clip
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+
+def _encode_segment(
+    cache: SegmentCache,
+    key: str,
+    asset_path: str,
+    clip: Dict[str, Any],
+    media_info: Dict[str, Any],
+    settings: Dict[str, Any],
+    job_id: str,
+    protect: set,
+    on_progress: Optional[Callable[[float], None]] = None,
+) -> Tuple[Path, str]:
+    """Encodes one segment into the cache; ``on_progress`` receives a 0..1 fraction."""
+    tmp_path = cache.tmp_path(key)
+    has_audio = bool(media_info.get("has_audio"))
+    smart_cut = _smart_cut_plan(asset_path, clip, settings, media_info)
+    try:
+        logs = None
+        if smart_cut:
+            parts, video_stream = smart_cut
+            logger.info(f"Smart cut for job {job_id} segment {key}: {parts}")
+            logs = _render_smart_cut(asset_path, parts, video_stream, settings, has_audio, str(tmp_path), job_id, on_progress)
+        if logs is None:
+            command = build_segment_command(asset_path, clip, settings, has_audio, str(tmp_path))
+            clip_duration = clip["source_out"] - clip["source_in"]
+            segment_progress = None
+            if on_progress and clip_duration > 0:
+                segment_progress = lambda seconds: on_progress(min(seconds / clip_duration, 1.0))
+            logs = run_ffmpeg_render(command, job_id, segment_progress)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return cache.put(key, tmp_path, protect=protect), logs
+
+
+def _encode_segments(
+    cache: SegmentCache,
+    keys: List[str],
+    asset_path: str,
+    clip: Dict[str, Any],
+    presets: List[Dict[str, Any]],
+    media_info: Dict[str, Any],
+    job_id: str,
+    protect: set,
+    on_progress: Optional[Callable[[float], None]] = None,
+) -> List[Path]:
+    """Encodes one clip into the cache for every preset in ``presets`` from a single decode."""
+    if len(keys) == 1:
+        path, _ = _encode_segment(cache, keys[0], asset_path, clip, media_info, presets[0], job_id, protect, on_progress)
+        return [path]
+
+    tmp_paths = [cache.tmp_path(key) for key in keys]
+    command = build_multi_segment_command(
+        asset_path, clip, [(settings, str(path)) for settings, path in zip(presets, tmp_paths)],
+        bool(media_info.get("has_audio")),
+    )
+    clip_duration = clip["source_out"] - clip["source_in"]
+    segment_progress = None
+    if on_progress and clip_duration > 0:
+        segment_progress = lambda seconds: on_progress(min(seconds / clip_duration, 1.0))
+    try:
+        run_ffmpeg_render(command, job_id, segment_progress)
+    except Exception:
+        for path in tmp_paths:
+            path.unlink(missing_ok=True)
+        raise
+    return [cache.put(key, path, protect=protect) for key, path in zip(keys, tmp_paths)]
+
+
+def _match_parameter_sets(
+    db: Session,
+    cache: SegmentCache,
+    keys: List[str],
+    sources: Dict[str, Tuple[str, Dict[str, Any], Dict[str, Any]]],
+    segment_paths: Dict[str, Path],
+    job_id: str,
+    protect: set,
+):
+    """
+    Re-encodes segments whose SPS/PPS differ from the rest of one output's concat list.
+
+    The concat demuxer keeps only the first segment's extradata, so a smart-cut segment copied
+    from a camera file (cached now or by an earlier render) cannot be joined with encoder
+    output or with copies from another source. Mismatching segments are fully re-encoded and
+    replace their cache entries; if those still differ from the remaining ones (the majority
+    were themselves copies), the remaining ones are re-encoded too.
+    """
+    hashes = {key: tasks.probe_extradata_hash(str(segment_paths[key])) for key in dict.fromkeys(keys)}
+    counts = collections.Counter(value for value in hashes.values() if value)
+    if len(counts) <= 1:
+        return
+
+    def _reencode(stale: List[str]) -> set:
+        for key in stale:
+            asset_path, clip, settings = sources[key]
+            logger.info(f"Segment {key} for job {job_id} has different parameter sets, re-encoding")
+            tmp_path = cache.tmp_path(key)
+            has_audio = bool(media.probe(db, asset_path).get("has_audio"))
+            command = build_segment_command(asset_path, clip, settings, has_audio, str(tmp_path))
+            try:
+                run_ffmpeg_render(command, job_id)
+            except Exception:
+                tmp_path.unlink(missing_ok=True)
+                raise
+            segment_paths[key] = cache.put(key, tmp_path, protect=protect)
+            hashes[key] = tasks.probe_extradata_hash(str(segment_paths[key]))
+        return {hashes[key] for key in stale} - {None}
+
+    reference = counts.most_common(1)[0][0]
+    encoded = _reencode([key for key, value in hashes.items() if value and value != reference])
+    if encoded and encoded != {reference}:
+        target = next(iter(encoded))
+        _reencode([key for key, value in hashes.items() if value and value != target])
+
+
+def render_segmented(
+    db: Session,
+    timeline: Dict[str, Any],
+    job_id: str,
+    cache: SegmentCache = segment_cache,
+    on_progress: Optional[Callable[[int], None]] = None,
+    pool_size: int = RENDER_POOL_SIZE,
+) -> Tuple[List[str], str]:
+    """
+    Renders a timeline clip by clip through the segment cache and joins the result.
+
+    Only clips whose source, in/out points or output settings changed since a previous
+    render are encoded; those are encoded concurrently, up to ``pool_size`` ffmpeg
+    processes at a time. With several output presets (see ``output_presets``) each clip is
+    decoded once for all presets it is missing from the cache. Returns one output path per
+    preset. ``on_progress`` receives 0..99 as segments are encoded, weighted by clip
+    duration; it may be called from pool threads.
+    """
+    presets = output_presets(timeline, job_id)
+    video_clips = _video_clips(timeline)
+    if not video_clips:
+        raise ValueError("No video clips found in the timeline.")
+
+    keys: List[List[str]] = [[] for _ in presets]
+    sources: Dict[str, Tuple[str, Dict[str, Any], Dict[str, Any]]] = {}
+    weights: Dict[str, float] = {}
+    for clip in video_clips:
+        asset_path = get_asset_path(db, clip["asset_id"])
+        for index, settings in enumerate(presets):
+            key = cache.key(_segment_spec(clip, asset_path, settings))
+            keys[index].append(key)
+            weights[key] = weights.get(key, 0.0) + max(clip["source_out"] - clip["source_in"], 0.0)
+            sources.setdefault(key, (asset_path, clip, settings))
+    needed = {key for preset_keys in keys for key in preset_keys}
+    # Held until the outputs are joined, so concurrent renders' puts cannot evict them
+    with cache.hold(needed):
+
+        segment_paths: Dict[str, Path] = {}
+        # Cache misses grouped by source range, so each range is decoded once for all its presets
+        to_encode: Dict[Tuple[str, float, float], List[str]] = {}
+        media_infos: Dict[str, Dict[str, Any]] = {}
+        for key, (asset_path, clip, settings) in sources.items():
+            cached = cache.get(key)
+            if cached:
+                logger.info(f"Segment cache hit for job {job_id}: {key}")
+                segment_paths[key] = cached
+                continue
+            source_range = (asset_path, float(clip["source_in"]), float(clip["source_out"]))
+            to_encode.setdefault(source_range, []).append(key)
+            if asset_path not in media_infos:
+                # Probe here rather than in the pool: the session must stay on this thread
+                media_infos[asset_path] = media.probe(db, asset_path)
+
+        total_weight = sum(weights.values()) or 1.0
+        fractions = {key: 1.0 for key in segment_paths}
+        fractions_lock = threading.Lock()
+
+        def _report(group: List[str] = (), fraction: float = 1.0):
+            if not on_progress:
+                return
+            with fractions_lock:
+                for key in group:
+                    fractions[key] = fraction
+                done_weight = sum(weights[k] * f for k, f in fractions.items())
+            on_progress(min(99, int(done_weight / total_weight * 99)))
+
+        _report()
+        if to_encode:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(pool_size, len(to_encode)))) as executor:
+                futures = {}
+                for (asset_path, _, _), group in to_encode.items():
+                    _, clip, _ = sources[group[0]]
+                    future = executor.submit(
+                        _encode_segments, cache, group, asset_path, clip, [sources[key][2] for key in group],
+                        media_infos[asset_path], job_id, needed,
+                        lambda fraction, group=group: _report(group, fraction),
+                    )
+                    futures[future] = group
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        group = futures[future]
+                        segment_paths.update(zip(group, future.result()))
+                        _report(group, 1.0)
+                except Exception:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+        temp_dir = work_dir(job_id)
+        os.makedirs(temp_dir, exist_ok=True)
+        output_paths = []
+        logs = ""
+        for index, settings in enumerate(presets):
+            _match_parameter_sets(db, cache, keys[index], sources, segment_paths, job_id, needed)
+            output_path = _output_path(settings["output_filename"])
+            command = build_concat_command(
+                [segment_paths[key] for key in keys[index]],
+                os.path.join(temp_dir, f"segments_{index}.txt"),
+                output_path,
+                faststart=True,
+            )
+            logs = run_ffmpeg_render(command, job_id)
+            output_paths.append(output_path)
+        return output_paths, logs
+
+
+def _offset_progress(
+    on_progress: Optional[Callable[[int], None]], offset: float, total: Optional[float]
+) -> Optional[Callable[[float], None]]:
+    """Maps an ffmpeg position (seconds into one chunk) onto 0..99 of the whole render."""
+    if not on_progress or not total:
+        return None
+    return lambda seconds: on_progress(min(99, int((offset + seconds) / total * 99)))
+
+
+def merge_tree(paths: List[Path], work_dir: Path, job_id: str, fanin: int = RENDER_MERGE_FANIN) -> List[Path]:
+    """
+    Stream-copies ``paths`` together level by level until at most ``fanin`` files remain.
+
+    Each merge step opens at most ``fanin`` inputs, so very long renders never need an
+    unbounded concat list. Returns the files for the final merge, still in order.
+    """
+    fanin = max(2, fanin)
+    level = 0
+    while len(paths) > fanin:
+        merged = []
+        for index in range(0, len(paths), fanin):
+            group = paths[index:index + fanin]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            merged_path = work_dir / f"merge_{level}_{index // fanin:05d}.mp4"
+            command = build_concat_command(
+                group,
+                str(work_dir / f"merge_{level}_{index // fanin:05d}.txt"),
+                str(merged_path),
+                output_args=["-video_track_timescale", "90000"],
+            )
+            run_ffmpeg_render(command, job_id)
+            merged.append(merged_path)
+        paths = merged
+        level += 1
+    return paths
+
+
+def render_chunked(
+    db: Session,
+    timeline: Dict[str, Any],
+    job_id: str,
+    preview: bool = False,
+    on_progress: Optional[Callable[[int], None]] = None,
+    chunk_size: int = RENDER_CHUNK_SIZE,
+) -> Tuple[str, str]:
+    """
+    Renders a timeline through the single-pass filtergraph, hierarchically for long timelines.
+
+    Up to ``chunk_size`` clips are rendered by one ffmpeg process. Longer timelines are rendered
+    ``chunk_size`` clips at a time into intermediates that are merged with stream copy (see
+    ``merge_tree``), so the number of open decoders and the command length stay bounded no
+    matter how many clips there are. ``on_progress`` receives 0..99.
+    """
+    video_clips = _video_clips(timeline)
+    total = timeline_duration(timeline) or None
+    if len(video_clips) <= chunk_size:
+        command, output_path = build_ffmpeg_command(db, timeline, job_id, preview)
+        return output_path, run_ffmpeg_render(command, job_id, _offset_progress(on_progress, 0.0, total))
+
+    chunks_dir = work_dir(job_id) / "chunks"
+    chunks_dir.mkdir(parents=True, exist_ok=True)
+    with_audio = any(
+        media.probe(db, get_asset_path(db, clip["asset_id"], preview=preview)).get("has_audio")
+        for clip in video_clips
+    )
+
+    chunk_paths = []
+    done = 0.0
+    for index in range(0, len(video_clips), chunk_size):
+        group = video_clips[index:index + chunk_size]
+        chunk_timeline = {**timeline, "tracks": [{"id": "chunk", "type": "video", "clips": group}]}
+        chunk_path = chunks_dir / f"chunk_{index // chunk_size:05d}.mp4"
+        command, _ = build_ffmpeg_command(
+            db, chunk_timeline, job_id, preview, intermediate_path=str(chunk_path), with_audio=with_audio
+        )
+        run_ffmpeg_render(command, job_id, _offset_progress(on_progress, done, total))
+        done += timeline_duration(chunk_timeline)
+        chunk_paths.append(chunk_path)
+
+    final_inputs = merge_tree(chunk_paths, chunks_dir, job_id)
+    if preview and PREVIEW_FORMAT == "hls":
+        hls_dir = preview_hls_dir(job_id)
+        output_path = str(hls_dir / HLS_PLAYLIST_NAME)
+        command = build_concat_command(
+            final_inputs, str(chunks_dir / "final.txt"), output_path,
+            output_args=_hls_output_args(hls_dir, force_keyframes=False),
+        )
+    else:
+        output_path = _output_path(_output_settings(timeline, job_id, preview)["output_filename"])
+        command = build_concat_command(final_inputs, str(chunks_dir / "final.txt"), output_path, faststart=True)
+    return output_path, run_ffmpeg_render(command, job_id)
+
+
+# Lines written by ``-progress pipe:1`` (frame=..., out_time_us=..., progress=continue)
+_PROGRESS_LINE = re.compile(r"^[a-z0-9_]+=\S*$")
+
+
+def run_ffmpeg_render(command: List[str], job_id: str, on_progress: Optional[Callable[[float], None]] = None):
+    """
+    Executes the ffmpeg command and logs the output.
+
+    Output goes to the job's log file; only a bounded tail is kept in memory and returned.
+    ``on_progress`` is called with ffmpeg's output position in seconds as it advances.
+    """
+    command = [command[0], "-progress", "pipe:1", "-nostats", *command[1:]]
+    job_log = joblog.open_log(job_id)
+    recent = collections.deque(maxlen=20)
+
+    with cpu_budget.slot() as threads:
+        command = with_threads(command, threads)
+        logger.info(f"Starting ffmpeg render for job {job_id}: {' '.join(command)}")
+        job_log.write(" ".join(command))
 
-    logs = []
-    while True:
-        line = process.stdout.readline()
-        if not line:
-            break
-        logger.info(line.strip())
-        logs.append(line.strip())
+        process = cpu_budget.popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+        while True:
+            line = process.stdout.readline()
+            if not line:
+                break
+            line = line.strip()
+            if _PROGRESS_LINE.match(line):
+                seconds = tasks.parse_progress_time(line)
+                if seconds is not None and on_progress:
+                    on_progress(seconds)
+                continue
+            logger.debug(line)
+            job_log.write(line)
+            recent.append(line)
 
-    process.wait()
+        process.wait()
 
     if process.returncode != 0:
         logger.error(f"ffmpeg render for job {job_id} failed with return code {process.returncode}")
-        raise RuntimeError(f"ffmpeg failed: {' '.join(logs)}")
+        raise RuntimeError(f"ffmpeg failed: {' '.join(recent)}")
 
     logger.info(f"ffmpeg render for job {job_id} completed successfully.")
-    return "".join(logs)
+    return job_log.tail()
@@ -1,8 +1,9 @@
 from typing import List, Optional
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Response
 from sqlalchemy.orm import Session
+from pathlib import Path
 from ..db import get_db
-from .. import crud, schemas
+from .. import crud, models, schemas
 
 router = APIRouter(prefix="/assets", tags=["assets"])
 
@@ -33,4 +34,25 @@ def get_all_assets_endpoint(
         return []
         
     # 3. Return the result. FastAPI handles the conversion to the response_model.
-    return assets    
+    return assets
+
+
+@router.delete("/{asset_id}", status_code=204, summary="Delete an asset and, once unreferenced, its files.")
+def delete_asset_endpoint(asset_id: str, db: Session = Depends(get_db)):
+    """
+    Deletes an asset.
+
+    Uploads with identical content share one stored master, proxy and thumbnails; those files
+    are removed only when the last asset referencing them is deleted.
+    """
+    asset = crud.get_asset(db, asset_id)
+    if not asset:
+        raise HTTPException(status_code=404, detail="Asset not found")
+
+    orphaned = crud.delete_asset(db, asset)
+    for path in orphaned:
+        Path(path).unlink(missing_ok=True)
+    if orphaned:
+        db.query(models.MediaProbe).filter(models.MediaProbe.path.in_(orphaned)).delete(synchronize_session=False)
+        db.commit()
+    return Response(status_code=204)
@@ -1,8 +1,8 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.orm import Session
 from ..db import get_db
-from .. import crud, models
-from ..schemas import JobOut
+from .. import crud, models, joblog
+from ..schemas import JobOut, JobLogChunk
 from typing import List
 import json
 
@@ -42,3 +42,33 @@ def get_job(job_id: str, db: Session = Depends(get_db)):
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
     return serialize_job(job)
+
+
+@router.get("/{job_id}/logs", response_model=JobLogChunk)
+def get_job_logs(
+    job_id: str,
+    offset: int = 0,
+    limit: int = Query(256 * 1024, ge=1, le=4 * 1024 * 1024),
+    db: Session = Depends(get_db),
+):
+    """
+    Read the job's full ffmpeg log from a byte offset.
+
+    Poll with the returned `next_offset` to tail a running job; a negative `offset`
+    returns the last `-offset` bytes.
+    """
+    job = crud.get_job(db, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    data, start, size = joblog.read_log(job_id, offset=offset, limit=limit)
+    next_offset = start + len(data)
+    finished = job.status in ("completed", "failed")
+    return JobLogChunk(
+        job_id=job_id,
+        offset=start,
+        next_offset=next_offset,
+        size=size,
+        data=data.decode("utf-8", "replace"),
+        complete=finished and next_offset >= size,
+    )
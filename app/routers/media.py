@@ -0,0 +1,65 @@
+from fastapi import APIRouter, Depends, HTTPException, Request
+from sqlalchemy.orm import Session
+from ..db import get_db
+from .. import crud, delivery, render
+from ..config import STORAGE_DIR
+
+router = APIRouter(prefix="/media", tags=["media"])
+
+FRAMES_DIR = STORAGE_DIR / "frames"
+
+# URL variant -> Asset column holding that file
+ASSET_VARIANTS = {
+    "master": "master_path",
+    "proxy": "proxy_path",
+    "scrub": "scrub_proxy_path",
+    "poster": "poster_path",
+    "filmstrip": "filmstrip_path",
+}
+
+
+@router.api_route("/assets/{asset_id}/{variant}", methods=["GET", "HEAD"])
+def get_asset_media(asset_id: str, variant: str, request: Request, db: Session = Depends(get_db)):
+    """
+    Serves an asset's master or one of its renditions, with Range and conditional request support.
+
+    Masters are content-addressed (the ETag is their sha256) and cached as immutable; renditions
+    can be regenerated, so clients revalidate them with the ETag.
+    """
+    column = ASSET_VARIANTS.get(variant)
+    if column is None:
+        raise HTTPException(status_code=404, detail="Unknown media variant")
+    asset = crud.get_asset(db, asset_id)
+    if not asset:
+        raise HTTPException(status_code=404, detail="Asset not found")
+    path = getattr(asset, column)
+    if not path:
+        raise HTTPException(status_code=404, detail=f"Asset has no {variant}")
+
+    if variant == "master" and asset.content_hash:
+        return delivery.serve_file(
+            request,
+            path,
+            etag=f'"{asset.content_hash}"',
+            cache_control=delivery.IMMUTABLE,
+        )
+    return delivery.serve_file(request, path)
+
+
+@router.api_route("/renders/{file_path:path}", methods=["GET", "HEAD"])
+def get_render_media(file_path: str, request: Request):
+    """
+    Serves render outputs, revalidated with their ETag.
+
+    Final renders are named after the requested output filename, so re-rendering an edited
+    timeline overwrites the same file; preview HLS playlists grow while the preview renders.
+    """
+    path = delivery.resolve_under(render.RENDERS_DIR, file_path)
+    return delivery.serve_file(request, path)
+
+
+@router.api_route("/frames/{file_path:path}", methods=["GET", "HEAD"])
+def get_frame_media(file_path: str, request: Request):
+    """Serves extracted transition frames."""
+    path = delivery.resolve_under(FRAMES_DIR, file_path)
+    return delivery.serve_file(request, path)
@@ -1,25 +1,27 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.orm import Session
+from pathlib import Path
 from ..db import get_db
-from .. import crud, worker
+from .. import crud, worker, render, storage, delivery
 from ..schemas import JobCreate, JobOut, RenderCreate
-from typing import Dict
+from typing import Dict, Optional, Tuple
+from sqlalchemy.exc import IntegrityError
 import json
 
 router = APIRouter(prefix="/renders", tags=["renders"])
 
 @router.post("/", status_code=202, response_model=JobOut)
 def start_render(payload: RenderCreate, db: Session = Depends(get_db)):
-    return _start_render_job(db, payload.project_id, preview=False)
+    return _start_render_job(db, payload.project_id, preview=False, window=payload.window)
 
 
 @router.post("/preview", status_code=202, response_model=JobOut)
 def start_preview_render(payload: RenderCreate, db: Session = Depends(get_db)):
-    """Starts a fast preview render job using proxy assets."""
-    return _start_render_job(db, payload.project_id, preview=True)
+    """Starts a fast preview render job using proxy assets, optionally for a time window only."""
+    return _start_render_job(db, payload.project_id, preview=True, window=payload.window)
 
 
-def _start_render_job(db: Session, project_id: str, preview: bool):
+def _start_render_job(db: Session, project_id: str, preview: bool, window: Optional[Tuple[float, float]] = None):
     """Helper to start a render or preview render job."""
     timeline_state = crud.get_timeline_state(db, project_id)
     if not timeline_state:
@@ -29,16 +31,82 @@ def _start_render_job(db: Session, project_id: str, preview: bool):
         )
 
     timeline_data = json.loads(timeline_state.data)
+    if window:
+        try:
+            timeline_data = render.window_timeline(timeline_data, *window)
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
     job_type = "preview-render" if preview else "render"
 
-    job = crud.create_job(db, type=job_type, payload=timeline_data, project_id=project_id)
+    # Identical inputs: hand back the finished render, or join the one in progress
+    render_hash = render.render_hash(db, timeline_data, preview)
+    existing = _memoized_render(db, render_hash, job_type)
+    if existing:
+        return existing
+
+    try:
+        job = crud.create_job(db, type=job_type, payload=timeline_data, project_id=project_id, render_hash=render_hash)
+    except IntegrityError:
+        # Another request (possibly in another API process) queued the same render meanwhile;
+        # uq_jobs_active_render allows only one queued or running job per hash
+        db.rollback()
+        existing = _memoized_render(db, render_hash, job_type)
+        if not existing:
+            raise
+        return existing
     worker.enqueue_job(job.id)
     return job
 
 
+def _memoized_render(db: Session, render_hash: Optional[str], job_type: str):
+    """A queued, running or intact completed job for the same inputs, if any."""
+    if not render_hash:
+        return None
+    for existing in crud.find_render_jobs(db, render_hash, job_type):
+        if existing.status != "completed" or _render_output_intact(existing):
+            return existing
+    return None
+
+
+def _render_output_intact(job) -> bool:
+    """True when the completed job's output files are still the ones it produced."""
+    payload = json.loads(job.payload or "{}")
+    outputs = payload.get("outputs")
+    if outputs is None and payload.get("output_path"):
+        outputs = [{"path": payload["output_path"], "fingerprint": payload.get("output_fingerprint")}]
+    if not outputs:
+        return False
+    try:
+        return all(storage.file_fingerprint(output["path"]) == output["fingerprint"] for output in outputs)
+    except OSError:
+        return False
+
+
 @router.get("/{job_id}", response_model=JobOut)
 def get_render_job(job_id: str, db: Session = Depends(get_db)):
     j = crud.get_job(db, job_id)
     if not j:
         raise HTTPException(status_code=404, detail="Job not found")
     return j
+
+
+HLS_MEDIA_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".ts": "video/mp2t",
+}
+
+
+@router.get("/{job_id}/hls/{filename}")
+def get_preview_stream_file(job_id: str, filename: str, request: Request):
+    """Serves the HLS playlist and segments of a preview render, including while it is still running."""
+    suffix = Path(filename).suffix
+    if Path(filename).name != filename or suffix not in HLS_MEDIA_TYPES:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    path = render.preview_hls_dir(job_id) / filename
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="Not found")
+
+    # The playlist is rewritten as segments are added; segments never change once written.
+    cache_control = "no-cache" if suffix == ".m3u8" else delivery.IMMUTABLE
+    return delivery.serve_file(request, path, cache_control=cache_control, media_type=HLS_MEDIA_TYPES[suffix])
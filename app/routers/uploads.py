@@ -1,12 +1,23 @@
-from fastapi import APIRouter, UploadFile, File, Depends, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, BackgroundTasks, UploadFile, File, Depends, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from ..db import get_db
-from .. import crud, storage, worker, schemas, tasks, models
-import uuid, os
+from ..db import SessionLocal, get_db
+from .. import crud, storage, worker, schemas, media, models, proxy_policy, ingest, delivery
+import hashlib, logging, uuid, os
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 from ..schemas import AssetOut
+from ..config import (
+    UPLOAD_SESSIONS_DIR,
+    UPLOAD_CHUNK_SIZE,
+    UPLOAD_MAX_CHUNK_SIZE,
+    UPLOAD_SESSION_TTL,
+    UPLOAD_FINALIZE_TIMEOUT,
+    LIVE_PROXY_INGEST,
+)
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/upload", tags=["uploads"])
 
@@ -18,6 +29,193 @@ async def upload_file(
     project_id: str = None, 
     db: Session = Depends(get_db)
 ):
+    # Everything blocking (disk, hashing, ffprobe, SQLAlchemy) runs in the threadpool so a
+    # large upload never stalls the event loop for other requests
+    await run_in_threadpool(_check_project, db, project_id)
+
+    # create deterministic unique filename
+    dest = _new_master_path(file.filename)
+    content_hash, size = await run_in_threadpool(_write_upload, file.file, dest)
+    return await run_in_threadpool(
+        _register_upload, db, dest, file.filename, file.content_type, project_id, content_hash, size
+    )
+
+
+@router.post("/stream")
+async def upload_stream(
+    request: Request,
+    filename: str,
+    project_id: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    """
+    Uploads a master sent as the raw request body; ``Content-Type`` is the media type.
+
+    Video in a streamable container (see ``ingest.is_streamable``) is piped into ffmpeg while
+    it arrives, so its proxy, scrub proxy and poster are ready moments after the last byte.
+    """
+    await run_in_threadpool(_check_project, db, project_id)
+    content_type = request.headers.get("content-type")
+    is_video = not content_type or content_type.startswith("video/")
+
+    dest = _new_master_path(filename)
+    writer = await run_in_threadpool(ingest.IngestWriter, dest, LIVE_PROXY_INGEST and is_video)
+    buffer = bytearray()
+    try:
+        async for data in request.stream():
+            buffer += data
+            if len(buffer) >= CHUNK_SIZE:
+                await run_in_threadpool(writer.write, bytes(buffer))
+                buffer.clear()
+        if buffer:
+            await run_in_threadpool(writer.write, bytes(buffer))
+        prepared = await run_in_threadpool(writer.finish)
+    except BaseException:
+        await run_in_threadpool(writer.abort)
+        raise
+
+    return await run_in_threadpool(
+        _register_upload, db, dest, filename, content_type, project_id, writer.content_hash, writer.size, prepared
+    )
+
+
+@router.post("/sessions", status_code=201, response_model=schemas.UploadSessionOut)
+def create_upload_session(payload: schemas.UploadSessionCreate, db: Session = Depends(get_db)):
+    """
+    Starts a resumable upload.
+
+    The target file is preallocated to the full size so chunks can be PUT in any order and
+    in parallel, each written in place at ``index * chunk_size``.
+    """
+    _check_project(db, payload.project_id)
+    _remove_expired_sessions(db)
+    chunk_size = min(payload.chunk_size or UPLOAD_CHUNK_SIZE, UPLOAD_MAX_CHUNK_SIZE)
+
+    UPLOAD_SESSIONS_DIR.mkdir(parents=True, exist_ok=True)
+    ext = os.path.splitext(payload.filename)[1] or ".mp4"
+    path = UPLOAD_SESSIONS_DIR / f"{uuid.uuid4().hex}{ext}.part"
+    with open(path, "wb") as fh:
+        fh.truncate(payload.size)
+
+    session = crud.create_upload_session(
+        db,
+        filename=payload.filename,
+        size=payload.size,
+        chunk_size=chunk_size,
+        path=str(path),
+        content_type=payload.content_type,
+        project_id=payload.project_id,
+    )
+    return _session_out(db, session)
+
+
+@router.get("/sessions/{upload_id}", response_model=schemas.UploadSessionOut)
+def get_upload_session(upload_id: str, db: Session = Depends(get_db)):
+    """Reports which chunks have arrived, so an interrupted client only resends the rest."""
+    return _session_out(db, _get_session(db, upload_id))
+
+
+@router.put("/sessions/{upload_id}/chunks/{index}", response_model=schemas.UploadSessionOut)
+async def put_upload_chunk(upload_id: str, index: int, request: Request, db: Session = Depends(get_db)):
+    """Writes one chunk (the raw request body) at its offset; chunks may be re-sent."""
+    session = await run_in_threadpool(_get_session, db, upload_id)
+    if session.status != "open":
+        raise HTTPException(status_code=409, detail="Upload session is already finalized")
+    total_chunks = _total_chunks(session)
+    if index < 0 or index >= total_chunks:
+        raise HTTPException(status_code=400, detail=f"Chunk index must be between 0 and {total_chunks - 1}")
+
+    offset = index * session.chunk_size
+    expected = min(session.chunk_size, session.size - offset)
+    written = 0
+    buffer = bytearray()
+    fd = await run_in_threadpool(os.open, session.path, os.O_WRONLY)
+    try:
+        async for data in request.stream():
+            if written + len(buffer) + len(data) > expected:
+                raise HTTPException(status_code=400, detail=f"Chunk {index} must be {expected} bytes")
+            buffer += data
+            # Batch the small pieces the ASGI server hands us into CHUNK_SIZE writes
+            if len(buffer) >= CHUNK_SIZE:
+                await run_in_threadpool(os.pwrite, fd, bytes(buffer), offset + written)
+                written += len(buffer)
+                buffer.clear()
+        if buffer:
+            await run_in_threadpool(os.pwrite, fd, bytes(buffer), offset + written)
+            written += len(buffer)
+    finally:
+        await run_in_threadpool(os.close, fd)
+    if written != expected:
+        raise HTTPException(status_code=400, detail=f"Chunk {index} must be {expected} bytes, got {written}")
+
+    await run_in_threadpool(crud.record_upload_chunk, db, upload_id, index, written)
+    return await run_in_threadpool(_session_out, db, session)
+
+
+@router.post("/sessions/{upload_id}/complete", status_code=202, response_model=schemas.UploadSessionOut)
+def complete_upload_session(upload_id: str, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
+    """
+    Finalizes a resumable upload once every chunk has arrived.
+
+    Hashing a multi-GB master takes minutes, so it runs after the response: the session reports
+    ``finalizing`` until the asset exists, then ``completed`` with its ``asset_id``. The file is
+    then moved into ``storage/assets`` with a rename (no copy) and goes through the same dedup,
+    probe and proxy flow as ``POST /upload/``. If that fails the session goes back to ``open``
+    with its file in place, so it can be completed again (or to ``failed`` if the file could not
+    be kept). A session stuck in ``finalizing`` for UPLOAD_FINALIZE_TIMEOUT, e.g. after a crash,
+    can be completed again too.
+    """
+    session = _get_session(db, upload_id)
+    missing = sorted(set(range(_total_chunks(session))) - set(crud.received_upload_chunks(db, upload_id)))
+    if missing:
+        raise HTTPException(status_code=409, detail={"message": "Upload is incomplete", "missing": missing})
+    if session.status in ("open", "finalizing") and not Path(session.path).exists():
+        raise HTTPException(status_code=409, detail="Upload file is gone; start a new upload session")
+    stale_before = datetime.now(timezone.utc) - timedelta(seconds=UPLOAD_FINALIZE_TIMEOUT)
+    if not crud.claim_upload_session(db, upload_id, stale_before):
+        raise HTTPException(status_code=409, detail="Upload session is already finalized")
+    background_tasks.add_task(_finalize_upload_session, upload_id)
+    db.refresh(session)
+    return _session_out(db, session)
+
+
+def _finalize_upload_session(upload_id: str):
+    db: Session = SessionLocal()
+    session = dest = None
+    try:
+        session = crud.get_upload_session(db, upload_id)
+        content_hash = storage.file_sha256(session.path)
+        dest = _new_master_path(session.filename)
+        os.replace(session.path, dest)
+        result = _register_upload(
+            db, dest, session.filename, session.content_type, session.project_id, content_hash, session.size
+        )
+        crud.finish_upload_session(db, upload_id, "completed", result["asset_id"])
+    except Exception:
+        logger.exception(f"Finalizing upload {upload_id} failed")
+        db.rollback()
+        if not session:
+            crud.finish_upload_session(db, upload_id, "failed")
+            return
+        # Unless a stored master now uses it (another upload of the same content linked to it)
+        if dest and dest.exists() and not crud.is_blob_master(db, str(dest)):
+            os.replace(dest, session.path)
+        crud.finish_upload_session(db, upload_id, "open" if Path(session.path).exists() else "failed")
+    finally:
+        db.close()
+
+
+def _remove_expired_sessions(db: Session):
+    """Deletes sessions (and their preallocated files) left without activity for UPLOAD_SESSION_TTL."""
+    before = datetime.now(timezone.utc) - timedelta(seconds=UPLOAD_SESSION_TTL)
+    for session in crud.expired_upload_sessions(db, before):
+        logger.info(f"Removing abandoned upload session {session.id}")
+        Path(session.path).unlink(missing_ok=True)
+        db.delete(session)
+    db.commit()
+
+
+def _check_project(db: Session, project_id: Optional[str]):
     if project_id:
         # Verify project exists before uploading
         project = db.query(models.Project).filter(models.Project.id == project_id).first()
@@ -25,54 +223,160 @@ async def upload_file(
             raise HTTPException(status_code=404, detail=f"Project {project_id} not found")
         print(f"Uploading to project: {project_id}")  # Debug log
 
-    # create deterministic unique filename
-    uid = uuid.uuid4().hex
-    ext = os.path.splitext(file.filename)[1] or ".mp4"
-    fname = uid + ext
-    dest = storage.STORAGE_DIR / "assets" / fname
-    dest.parent.mkdir(parents=True, exist_ok=True)
-    # save file in streaming chunks to avoid loading large files into memory
+
+def _write_upload(src, dest: Path) -> Tuple[str, int]:
+    """
+    Copies an upload's spooled body to ``dest`` and returns ``(sha256, size)``.
+
+    Hashing happens during the copy so identical content can share one stored master.
+    """
     size = 0
+    hasher = hashlib.sha256()
+    src.seek(0)
     with open(dest, "wb") as buffer:
         while True:
-            chunk = await file.read(CHUNK_SIZE)
+            chunk = src.read(CHUNK_SIZE)
             if not chunk:
                 break
             size += len(chunk)
+            hasher.update(chunk)
             buffer.write(chunk)
-    await file.seek(0)
+    return hasher.hexdigest(), size
+
+
+def _new_master_path(filename: str) -> Path:
+    uid = uuid.uuid4().hex
+    ext = os.path.splitext(filename)[1] or ".mp4"
+    dest = storage.STORAGE_DIR / "assets" / (uid + ext)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    return dest
+
+
+def _get_session(db: Session, upload_id: str) -> models.UploadSession:
+    session = crud.get_upload_session(db, upload_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return session
+
+
+def _total_chunks(session: models.UploadSession) -> int:
+    return -(-session.size // session.chunk_size)
+
+
+def _session_out(db: Session, session: models.UploadSession) -> schemas.UploadSessionOut:
+    received = crud.received_upload_chunks(db, session.id)
+    total_chunks = _total_chunks(session)
+    bytes_received = sum(min(session.chunk_size, session.size - i * session.chunk_size) for i in received)
+    return schemas.UploadSessionOut(
+        upload_id=session.id,
+        filename=session.filename,
+        size=session.size,
+        chunk_size=session.chunk_size,
+        total_chunks=total_chunks,
+        received=received,
+        bytes_received=bytes_received,
+        status=session.status,
+        asset_id=session.asset_id,
+    )
+
+
+def _register_upload(
+    db: Session,
+    dest: Path,
+    filename: str,
+    content_type: Optional[str],
+    project_id: Optional[str],
+    content_hash: str,
+    size: int,
+    prepared: Optional[Dict[str, str]] = None,
+) -> Dict[str, Any]:
+    """
+    Creates the asset for a stored upload: dedup by content hash, probe, then queue the proxy job.
+
+    ``prepared`` maps Asset columns to renditions already built during a streaming upload.
+    """
+    master_path = crud.acquire_media_blob(db, content_hash, str(dest), size)
     # create DB record
     asset_type = "video"
-    if file.content_type:
-        if file.content_type.startswith("image/"):
+    if content_type:
+        if content_type.startswith("image/"):
             asset_type = "image"
-        elif file.content_type.startswith("audio/"):
+        elif content_type.startswith("audio/"):
             asset_type = "audio"
 
-    media_info = tasks.probe_media(str(dest))
-    duration = media_info.get("duration") if media_info else None
-    frame_rate = media_info.get("frame_rate") if media_info else None
+    try:
+        media_info = media.probe(db, master_path)
+        duration = media_info.get("duration") if media_info else None
+        frame_rate = media_info.get("frame_rate") if media_info else None
 
-    asset = crud.create_asset(
-        db,
-        filename=file.filename,
-        master_path=str(dest),
-        project_id=project_id,
-        asset_type=asset_type,
-        duration=duration,
-        frame_rate=frame_rate,
-        metadata=media_info or None,
-    )
-    # create proxy job
-    job = crud.create_job(db, type="proxy", payload={"assets": [asset.id]}, project_id=asset.project_id)
-    worker.enqueue_job(job.id)
+        asset = crud.create_asset(
+            db,
+            filename=filename,
+            master_path=master_path,
+            project_id=project_id,
+            asset_type=asset_type,
+            duration=duration,
+            frame_rate=frame_rate,
+            metadata=media_info or None,
+            content_hash=content_hash,
+        )
+    except Exception:
+        # No asset holds the reference; without it a retry (or the next upload of this content)
+        # could be handed a master this failed upload no longer keeps
+        db.rollback()
+        crud.release_media_blob(db, content_hash)
+        raise
+    if master_path != str(dest):
+        # Already stored: link to the existing master and drop this copy
+        dest.unlink(missing_ok=True)
+        for path in (prepared or {}).values():
+            Path(path).unlink(missing_ok=True)
+        prepared = None
+    # create proxy job, unless there is nothing to derive (e.g. audio) or the same
+    # content was already processed, or is being processed, for another asset
+    job = None
+    processed = crud.find_processed_asset(db, content_hash)
+    pending_job_id = None if processed else crud.pending_blob_proxy(db, content_hash)
+    proxy_action = proxy_policy.decide(asset_type, master_path, media_info)[0]
+    if prepared and proxy_action != proxy_policy.ENCODE:
+        # Judged from the whole file (e.g. keyframe spacing), the master can serve as its own proxy
+        for path in prepared.values():
+            Path(path).unlink(missing_ok=True)
+        prepared = None
+    if processed and processed.id != asset.id:
+        for field in crud.DERIVED_FIELDS:
+            setattr(asset, field, getattr(processed, field))
+        db.add(asset); db.commit(); db.refresh(asset)
+        for path in (prepared or {}).values():
+            Path(path).unlink(missing_ok=True)
+    elif prepared:
+        for field, path in prepared.items():
+            setattr(asset, field, path)
+        # Prime the probe cache so preview renders never probe the proxy.
+        media.probe(db, prepared["proxy_path"])
+        db.add(asset); db.commit(); db.refresh(asset)
+        if duration:
+            # Only the filmstrip is left; it is cut from the proxy, not the master
+            job = crud.create_job(
+                db, type="proxy", payload={"assets": [asset.id], "missing_only": True}, project_id=asset.project_id
+            )
+            worker.enqueue_job(job.id)
+    elif pending_job_id:
+        # Another upload of this content is still being processed; its job shares the files with this asset
+        job = crud.get_job(db, pending_job_id)
+    elif proxy_action != proxy_policy.NONE:
+        job = crud.create_job(db, type="proxy", payload={"assets": [asset.id]}, project_id=asset.project_id)
+        # Claimed now rather than when the job starts, so uploads arriving meanwhile wait for it
+        crud.claim_blob_proxy(db, content_hash, job.id)
+        worker.enqueue_job(job.id)
     download_url = f"/upload/{asset.id}/file"
     return {
         "asset_id": asset.id,
         "master_path": asset.master_path,
+        "content_hash": asset.content_hash,
         "asset_type": asset.asset_type,
         "project_id": asset.project_id,
-        "proxy_job": job.id,
+        "proxy_job": job.id if job else None,
         "download_url": download_url,
         "duration": duration,
         "frame_rate": frame_rate,
@@ -88,8 +392,8 @@ def get_asset(asset_id: str, db: Session = Depends(get_db)):
     return asset_out
 
 
-@router.get("/{asset_id}/file")
-def download_asset(asset_id: str, db: Session = Depends(get_db)):
+@router.api_route("/{asset_id}/file", methods=["GET", "HEAD"])
+def download_asset(asset_id: str, request: Request, db: Session = Depends(get_db)):
     asset = crud.get_asset(db, asset_id)
     if not asset:
         raise HTTPException(status_code=404, detail="Asset not found")
@@ -98,6 +402,10 @@ def download_asset(asset_id: str, db: Session = Depends(get_db)):
     if not path.exists():
         raise HTTPException(status_code=404, detail="Asset file missing")
 
-    media_type = storage.guess_mime_type(path)
-    return FileResponse(path, media_type=media_type, filename=asset.filename or path.name)
+    if asset.content_hash:
+        return delivery.serve_file(
+            request, path, etag=f'"{asset.content_hash}"', cache_control=delivery.IMMUTABLE,
+            filename=asset.filename or path.name,
+        )
+    return delivery.serve_file(request, path, filename=asset.filename or path.name)
     
@@ -1,5 +1,5 @@
-from pydantic import BaseModel, ConfigDict, model_validator
-from typing import Optional, List, Dict, Any
+from pydantic import BaseModel, ConfigDict, Field, model_validator
+from typing import Optional, List, Dict, Any, Literal, Tuple, Union
 from datetime import datetime
 import json
 
@@ -11,7 +11,11 @@ class AssetOut(BaseModel):
     id: str
     filename: str
     master_path: str
+    content_hash: Optional[str] = None
     proxy_path: Optional[str] = None
+    scrub_proxy_path: Optional[str] = None
+    poster_path: Optional[str] = None
+    filmstrip_path: Optional[str] = None
     asset_type: Optional[str] = "video"
     duration: Optional[float] = None
     frame_rate: Optional[float] = None
@@ -19,6 +23,24 @@ class AssetOut(BaseModel):
 
     model_config = ConfigDict(from_attributes=True)
 
+class UploadSessionCreate(BaseModel):
+    filename: str
+    size: int = Field(gt=0)
+    content_type: Optional[str] = None
+    project_id: Optional[str] = None
+    chunk_size: Optional[int] = Field(default=None, gt=0)
+
+class UploadSessionOut(BaseModel):
+    upload_id: str
+    filename: str
+    size: int
+    chunk_size: int
+    total_chunks: int
+    received: List[int]
+    bytes_received: int
+    status: str
+    asset_id: Optional[str] = None
+
 class JobCreate(BaseModel):
     project_id: Optional[str]
     type: str
@@ -55,6 +77,15 @@ class JobOut(BaseModel):
         return data
 
 
+class JobLogChunk(BaseModel):
+    job_id: str
+    offset: int           # byte offset of `data` in the uncompressed log
+    next_offset: int      # pass back as `offset` to continue tailing
+    size: int             # uncompressed bytes available so far
+    data: str
+    complete: bool        # job finished and everything up to `size` has been returned
+
+
 class Effect(BaseModel):
     name: str
     parameters: Dict
@@ -86,13 +117,26 @@ class OutputSettings(BaseModel):
     resolution: str
     framerate: int
     bitrate: Optional[str] = None
+    # How to reach the target aspect ratio: stretch (default), crop or pad
+    fit: Optional[Literal["stretch", "crop", "pad"]] = None
 
 class Timeline(BaseModel):
-    output_settings: OutputSettings
+    # One preset, or a list of presets rendered from a single decode
+    output_settings: Union[OutputSettings, List[OutputSettings]]
     tracks: List[Track]
 
 class RenderCreate(BaseModel):
     project_id: str
+    # Optional [start, end] in timeline seconds; only that part of the timeline is rendered
+    window: Optional[Tuple[float, float]] = None
+
+    @model_validator(mode='after')
+    def check_window(self):
+        if self.window is not None:
+            start, end = self.window
+            if start < 0 or end <= start:
+                raise ValueError("window must be [start, end] with 0 <= start < end")
+        return self
 
 class TimelineStateUpdate(BaseModel):
     data: Dict[str, Any]
@@ -146,11 +190,20 @@ class AssetRead(BaseModel):
     filename: str
     asset_type: str
     master_path: str
+    content_hash: Optional[str] = None
     proxy_path: Optional[str] = None
+    scrub_proxy_path: Optional[str] = None
+    poster_path: Optional[str] = None
+    filmstrip_path: Optional[str] = None
     duration: Optional[float] = None
     frame_rate: Optional[float] = None
     original_width: Optional[str] = None
     original_height: Optional[str] = None
+    has_audio: Optional[bool] = None
+    video_codec: Optional[str] = None
+    audio_codec: Optional[str] = None
+    pix_fmt: Optional[str] = None
+    keyframe_interval: Optional[float] = None
     is_available: bool
     
     class Config:
@@ -0,0 +1,135 @@
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+from .config import SEGMENT_CACHE_DIR, SEGMENT_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+# How long the size index is trusted before the directory is scanned again, which picks up
+# segments written or removed by other processes sharing the cache
+_RESCAN_SECONDS = 300.0
+
+
+class SegmentCache:
+    """Content-addressed store of rendered clip segments.
+
+    Each segment is keyed by a hash of everything that affects its pixels and samples
+    (source fingerprint, in/out points, output settings), so unchanged clips are reused
+    across renders. Hits bump the file mtime and eviction drops the oldest files first.
+    Sizes are kept in an in-memory index, so a put does not scan the whole directory, and
+    segments held by any render in this process (see ``hold``) are never evicted.
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[float, int]] = {}  # key -> (mtime, size)
+        self._total = 0
+        self._scanned_at: Optional[float] = None
+        self._in_use: collections.Counter = collections.Counter()
+
+    def key(self, spec: Dict[str, Any]) -> str:
+        canonical = json.dumps(spec, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def path_for(self, key: str) -> Path:
+        return self.root / key[:2] / f"{key}.mp4"
+
+    def get(self, key: str) -> Optional[Path]:
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = (time.time(), self._entries[key][1])
+        return path
+
+    @contextlib.contextmanager
+    def hold(self, keys: Iterable[str]) -> Iterator[None]:
+        """Keeps ``keys`` from being evicted, by any render in this process, until the block exits."""
+        keys = list(keys)
+        with self._lock:
+            self._in_use.update(keys)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_use.subtract(keys)
+                self._in_use += collections.Counter()  # drop keys no longer held
+
+    def tmp_path(self, key: str) -> Path:
+        tmp_dir = self.root / "tmp"
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        return tmp_dir / f"{key}.{uuid.uuid4().hex[:8]}.mp4"
+
+    def put(self, key: str, src: Path, protect: Iterable[str] = ()) -> Path:
+        """Move a freshly encoded segment into the cache and enforce the size bound."""
+        path = self.path_for(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(src, path)
+        st = path.stat()
+        with self._lock:
+            self._record(key, st.st_mtime, st.st_size)
+        self.evict(protect=set(protect) | {key})
+        return path
+
+    def _record(self, key: str, mtime: float, size: int):
+        previous = self._entries.get(key)
+        if previous:
+            self._total -= previous[1]
+        self._entries[key] = (mtime, size)
+        self._total += size
+
+    def _scan(self):
+        self._entries = {}
+        self._total = 0
+        for path in self.root.glob("??/*.mp4"):
+            try:
+                st = path.stat()
+            except FileNotFoundError:
+                continue
+            self._record(path.stem, st.st_mtime, st.st_size)
+        self._scanned_at = time.monotonic()
+
+    def evict(self, protect: Iterable[str] = ()) -> int:
+        """Delete least-recently-used segments until the cache fits; returns bytes freed."""
+        if self.max_bytes <= 0:
+            return 0
+        protected = set(protect)
+        with self._lock:
+            if self._scanned_at is None or time.monotonic() - self._scanned_at > _RESCAN_SECONDS:
+                self._scan()
+            if self._total <= self.max_bytes:
+                return 0
+
+            freed = 0
+            for key, (_mtime, size) in sorted(self._entries.items(), key=lambda e: e[1][0]):
+                if self._total <= self.max_bytes:
+                    break
+                if key in protected or key in self._in_use:
+                    continue
+                try:
+                    self.path_for(key).unlink()
+                    freed += size
+                except FileNotFoundError:
+                    pass
+                del self._entries[key]
+                self._total -= size
+            if freed:
+                logger.info(f"Evicted {freed} bytes from segment cache {self.root}")
+            return freed
+
+
+segment_cache = SegmentCache(SEGMENT_CACHE_DIR, SEGMENT_CACHE_MAX_BYTES)
@@ -1,3 +1,4 @@
+import hashlib
 import os
 import mimetypes
 from pathlib import Path
@@ -25,3 +26,34 @@ def ensure_dir(path: str):
 def guess_mime_type(path: Path) -> str:
     mime, _ = mimetypes.guess_type(str(path))
     return mime or "application/octet-stream"
+
+
+def proxy_path(master_path: str, suffix: str = ".mp4") -> str:
+    """Where a master's editing proxy is written: H.264 MP4 (or JPEG for images) whatever the master's container."""
+    master = Path(master_path)
+    return str(master.with_name(f"proxy_{master.stem}{suffix}"))
+
+
+def rendition_paths(master_path: str) -> dict:
+    """Where the extra renditions of a video master are written, keyed by Asset column."""
+    master = Path(master_path)
+    return {
+        "scrub_proxy_path": str(master.with_name(f"scrub_{master.stem}.mp4")),
+        "poster_path": str(master.with_name(f"poster_{master.stem}.jpg")),
+        "filmstrip_path": str(master.with_name(f"filmstrip_{master.stem}.jpg")),
+    }
+
+
+def file_fingerprint(path) -> str:
+    """Cheap identity for a file on disk: size plus modification time in ns."""
+    st = os.stat(path)
+    return f"{st.st_size}:{st.st_mtime_ns}"
+
+
+def file_sha256(path, chunk_size: int = 1024 * 1024) -> str:
+    """sha256 of a file's contents, read in chunks."""
+    hasher = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
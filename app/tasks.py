@@ -1,19 +1,155 @@
 import subprocess
 import json
 from pathlib import Path
-from .config import FFMPEG_BIN
-from typing import List, Dict, Any
+from .config import FFMPEG_BIN, PROXY_HEIGHT, SCRUB_PROXY_HEIGHT, FILMSTRIP_FRAMES, FILMSTRIP_TILE_WIDTH
+from .cpu_budget import cpu_budget, with_threads
+from typing import Callable, List, Dict, Any, Optional
 
-def create_proxy(master_path: str, proxy_path: str, height: int = 480):
+def parse_progress_time(line: str) -> Optional[float]:
+    """Return the output position in seconds from an ffmpeg ``-progress`` line, if it carries one."""
+    key, sep, value = line.strip().partition("=")
+    # out_time_ms is (despite its name) also microseconds in ffmpeg's progress output
+    if not sep or key not in ("out_time_us", "out_time_ms"):
+        return None
+    try:
+        return int(value) / 1_000_000
+    except ValueError:
+        return None
+
+
+def run_ffmpeg(cmd: List[str]):
+    """``subprocess.check_call`` for ffmpeg, run inside the global CPU budget."""
+    with cpu_budget.slot() as threads:
+        cmd = with_threads(cmd, threads)
+        returncode = cpu_budget.popen(cmd).wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def run_with_progress(cmd: List[str], on_progress: Optional[Callable[[float], None]] = None):
+    """Like ``run_ffmpeg`` but feeds ffmpeg's output position (seconds) to ``on_progress``."""
+    cmd = [cmd[0], "-progress", "pipe:1", "-nostats", *cmd[1:]]
+    with cpu_budget.slot() as threads:
+        cmd = with_threads(cmd, threads)
+        process = cpu_budget.popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+        for line in process.stdout:
+            seconds = parse_progress_time(line)
+            if seconds is not None and on_progress:
+                on_progress(seconds)
+        process.wait()
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+
+
+def create_proxy(
+    master_path: str,
+    proxy_path: Optional[str],
+    height: int = PROXY_HEIGHT,
+    on_progress: Optional[Callable[[float], None]] = None,
+    duration: Optional[float] = None,
+    *,
+    remux: bool = False,
+    scrub_path: Optional[str] = None,
+    poster_path: Optional[str] = None,
+    filmstrip_path: Optional[str] = None,
+):
+    """
+    Encode an editing proxy, plus any requested extra renditions, from one decode of the master.
+
+    See ``proxy_command`` for the renditions. ``on_progress`` receives a 0..1 fraction when
+    ``duration`` is known.
+    """
+    cmd = proxy_command(
+        master_path,
+        proxy_path,
+        height,
+        duration,
+        remux=remux,
+        scrub_path=scrub_path,
+        poster_path=poster_path,
+        filmstrip_path=filmstrip_path,
+    )
+    if cmd is None:
+        return proxy_path
+
+    if on_progress and duration:
+        run_with_progress(cmd, lambda seconds: on_progress(min(seconds / duration, 1.0)))
+    else:
+        run_ffmpeg(cmd)
+    return proxy_path
+
+
+def proxy_command(
+    input_path: str,
+    proxy_path: Optional[str],
+    height: int = PROXY_HEIGHT,
+    duration: Optional[float] = None,
+    *,
+    remux: bool = False,
+    scrub_path: Optional[str] = None,
+    poster_path: Optional[str] = None,
+    filmstrip_path: Optional[str] = None,
+) -> Optional[List[str]]:
+    """
+    Builds one ffmpeg command that writes the proxy and every requested rendition from a single decode.
+
+    With ``remux`` the proxy's video is stream-copied instead of re-encoded; with no
+    ``proxy_path`` only the extra renditions are written. ``scrub_path`` gets a silent
+    SCRUB_PROXY_HEIGHT copy with short GOPs for fast seeking, ``poster_path`` a representative
+    JPEG picked from the opening frames and ``filmstrip_path`` a sprite sheet of FILMSTRIP_FRAMES
+    evenly spaced thumbnails (only when ``duration`` is known). ``input_path`` may be ``pipe:0``.
+    Returns None when there is nothing to write.
+    """
+    outputs = []
+    if proxy_path and not remux:
+        outputs.append((
+            f"scale=-2:{height}",
+            ["-map", "0:a?", "-c:v", "libx264", "-preset", "fast", "-crf", "23", "-c:a", "aac", "-b:a", "128k"],
+            proxy_path,
+        ))
+    if scrub_path:
+        outputs.append((
+            f"scale=-2:{SCRUB_PROXY_HEIGHT}",
+            ["-an", "-c:v", "libx264", "-preset", "veryfast", "-crf", "28", "-g", "12"],
+            scrub_path,
+        ))
+    if poster_path:
+        # Scale before thumbnail: it buffers its whole batch of candidate frames
+        outputs.append((f"scale=-2:'min({height},ih)',thumbnail", ["-frames:v", "1", "-q:v", "2"], poster_path))
+    if filmstrip_path and duration:
+        outputs.append((
+            f"fps={FILMSTRIP_FRAMES / duration:.6f},scale={FILMSTRIP_TILE_WIDTH}:-2,tile={FILMSTRIP_FRAMES}x1",
+            ["-frames:v", "1", "-q:v", "3"],
+            filmstrip_path,
+        ))
+
+    if not outputs and not (proxy_path and remux):
+        return None
+
+    cmd = [FFMPEG_BIN, "-i", input_path]
+    if outputs:
+        graph = [f"[0:v]split={len(outputs)}" + "".join(f"[src{i}]" for i in range(len(outputs)))]
+        graph += [f"[src{i}]{chain}[out{i}]" for i, (chain, _, _) in enumerate(outputs)]
+        cmd += ["-filter_complex", ";".join(graph)]
+        for i, (_, args, path) in enumerate(outputs):
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
+            cmd += ["-map", f"[out{i}]", *args, "-y", path]
+    if proxy_path and remux:
+        # Stream copy needs no decode; it shares the demuxer with the filtered outputs
+        Path(proxy_path).parent.mkdir(parents=True, exist_ok=True)
+        cmd += ["-map", "0:v:0", "-map", "0:a?", "-c:v", "copy", "-c:a", "aac", "-b:a", "128k", "-y", proxy_path]
+    return cmd
+
+def create_still_proxy(image_path: str, proxy_path: str, height: int = PROXY_HEIGHT):
+    """Downscale an image to a JPEG at most ``height`` pixels tall."""
     Path(proxy_path).parent.mkdir(parents=True, exist_ok=True)
     cmd = [
-        FFMPEG_BIN, "-y", "-i", master_path,
-        "-vf", f"scale=-2:{height}",
-        "-c:v", "libx264", "-preset", "fast", "-crf", "23",
-        "-c:a", "aac", "-b:a", "128k",
-        proxy_path
+        FFMPEG_BIN, "-y", "-i", image_path,
+        "-vf", f"scale=-2:'min({height},ih)'",
+        "-frames:v", "1", "-q:v", "3",
+        proxy_path,
     ]
-    subprocess.check_call(cmd)
+    run_ffmpeg(cmd)
     return proxy_path
 
 def concat_files_reencode(input_paths: List[str], out_path: str):
@@ -31,7 +167,7 @@ def concat_files_reencode(input_paths: List[str], out_path: str):
         vf += f"[{i}:v:0][{i}:a:0]"
     vf += f"concat=n={n}:v=1:a=1[outv][outa]"
     cmd += ["-filter_complex", vf, "-map", "[outv]", "-map", "[outa]", "-c:v", "libx264", "-preset", "medium", "-crf", "22", out_path]
-    subprocess.check_call(cmd)
+    run_ffmpeg(cmd)
     return out_path
 
 
@@ -51,7 +187,7 @@ def _extract_frame(video_path: str, frame_path: str, *, from_end: bool = False,
         cmd += ["-ss", f"{max(offset, 0):.3f}"]
 
     cmd += ["-i", video_path, "-frames:v", "1", "-q:v", "2", frame_path]
-    subprocess.check_call(cmd)
+    run_ffmpeg(cmd)
     return frame_path
 
 
@@ -63,6 +199,69 @@ def extract_last_frame(video_path: str, frame_path: str, offset: float = 0.08):
     return _extract_frame(video_path, frame_path, from_end=True, offset=offset)
 
 
+def probe_keyframes(path: str, start: Optional[float] = None, end: Optional[float] = None) -> List[float]:
+    """Return sorted keyframe timestamps (seconds) of the first video stream.
+
+    Reads packet flags only, so nothing is decoded. ``start``/``end`` limit the scan to
+    that interval (ffprobe seeks to the keyframe at or before ``start``).
+    """
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "packet=pts_time,flags",
+        "-of",
+        "csv=print_section=0",
+    ]
+    if start is not None or end is not None:
+        interval = f"{start or 0}%"
+        if end is not None:
+            interval += f"{end}"
+        cmd += ["-read_intervals", interval]
+    cmd.append(path)
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return []
+
+    keyframes = []
+    for line in result.stdout.splitlines():
+        parts = line.strip().split(",")
+        if len(parts) < 2 or "K" not in parts[1]:
+            continue
+        try:
+            keyframes.append(float(parts[0]))
+        except ValueError:
+            continue
+    return sorted(keyframes)
+
+
+def probe_extradata_hash(path: str) -> Optional[str]:
+    """Hash of the first video stream's codec extradata (e.g. H.264 SPS/PPS), or None if it has none."""
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_data_hash",
+        "SHA256",
+        "-show_entries",
+        "stream=extradata_hash",
+        "-of",
+        "csv=print_section=0",
+        path,
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+    return result.stdout.strip() or None
+
+
 def probe_media(path: str) -> Dict[str, Any]:
     cmd = [
         "ffprobe",
@@ -115,10 +314,26 @@ def probe_media(path: str) -> Dict[str, Any]:
         duration = _parse_float(video_stream.get("duration"))
 
     frame_rate = _parse_frame_rate(video_stream.get("avg_frame_rate")) if video_stream else None
+    audio_stream = next((s for s in streams if s.get("codec_type") == "audio"), None)
+
+    keyframe_interval = None
+    if video_stream:
+        # Sample the opening stretch of the file; GOP structure rarely changes mid-file.
+        keyframes = probe_keyframes(path, 0, 30)
+        gaps = sorted(b - a for a, b in zip(keyframes, keyframes[1:]) if b > a)
+        if gaps:
+            keyframe_interval = gaps[len(gaps) // 2]
 
     return {
         "duration": duration,
         "frame_rate": frame_rate,
+        "width": video_stream.get("width") if video_stream else None,
+        "height": video_stream.get("height") if video_stream else None,
+        "has_audio": audio_stream is not None,
+        "video_codec": video_stream.get("codec_name") if video_stream else None,
+        "audio_codec": audio_stream.get("codec_name") if audio_stream else None,
+        "pix_fmt": video_stream.get("pix_fmt") if video_stream else None,
+        "keyframe_interval": keyframe_interval,
         "streams": streams,
         "format": fmt,
     }
@@ -1,8 +1,11 @@
-import threading, queue, time, json, os
+import threading, json, os, time
+import logging
 import concurrent.futures
 from sqlalchemy.orm import Session
-from .db import SessionLocal
-from . import crud, tasks, higgsfield, render, hailuo
+from .db import SessionLocal, init_db
+from . import crud, tasks, higgsfield, render, hailuo, media, joblog, storage, proxy_policy, jobqueue, executors
+from .progress import ProgressReporter
+from .cpu_budget import cpu_budget
 from .config import (
     STORAGE_DIR,
     HAILUO_DEFAULT_DURATION,
@@ -15,8 +18,11 @@ from .config import (
     HAILUO_TIMEOUT,
     HAILUO_POLL_INTERVAL,
     HAILUO_MAX_POLLS,
+    PREVIEW_FORMAT,
+    WORKER_SHUTDOWN_TIMEOUT,
+    JOB_POLL_INTERVAL,
 )
-from typing import Dict
+from typing import Dict, List, Optional
 from pathlib import Path
 import httpx
 import boto3
@@ -26,10 +32,14 @@ import mimetypes
 import uuid
 from urllib.parse import quote
 
-job_q = queue.Queue()
-hailuo_poll_q = queue.Queue()
+logger = logging.getLogger(__name__)
 
 _r2_client = None
+# Set when a standalone worker shuts down: loops stop claiming and stopped jobs are handed back
+_stopping = threading.Event()
+_threads: List[threading.Thread] = []
+# Longest wait between retries while the queue database is unreachable
+_QUEUE_RETRY_MAX_DELAY = 60.0
 
 
 def _get_r2_client():
@@ -79,11 +89,15 @@ def _publish_render(path: Path) -> str:
 
 
 def enqueue_job(job_id: str):
-    job_q.put(job_id)
+    jobqueue.enqueue(job_id)
 
 
-def _enqueue_hailuo_poll(job_id: str):
-    hailuo_poll_q.put(job_id)
+def _enqueue_hailuo_poll(job_id: str, delay: float = 0.0):
+    """Moves the claimed Hailuo job to the poll queue (or back into it after ``delay``)."""
+    jobqueue.requeue(job_id, queue=jobqueue.HAILUO_POLL, delay=delay)
+
+def _preview_stream_url(job_id: str) -> str:
+    return f"{PUBLIC_BASE_URL.rstrip('/')}/renders/{quote(job_id)}/hls/{render.HLS_PLAYLIST_NAME}"
 
 def _to_public_url(path: Path) -> str:
     try:
@@ -91,12 +105,9 @@ def _to_public_url(path: Path) -> str:
     except ValueError:
         rel = path.name
     rel_str = str(rel).replace(os.sep, "/")
-    if rel_str.startswith("frames/"):
-        frame_path = rel_str[len("frames/") :]
-        return f"{PUBLIC_BASE_URL.rstrip('/')}/frames/{quote(frame_path)}"
-    if rel_str.startswith("renders/"):
-        render_path = rel_str[len("renders/") :]
-        return f"{PUBLIC_BASE_URL.rstrip('/')}/renders/{quote(render_path)}"
+    if rel_str.startswith(("frames/", "renders/")):
+        # Served by routers/media.py with Range and conditional request support
+        return f"{PUBLIC_BASE_URL.rstrip('/')}/media/{quote(rel_str)}"
     raise RuntimeError(f"Unsupported public URL path: {path}")
 
 
@@ -126,34 +137,165 @@ def _prepare_frame(job_id: str, asset, *, start: bool) -> tuple[Path, bool]:
 
     return frame_path, True
 
-def _restore_pending_jobs():
-    from . import models
+def _generate_proxies(db: Session, asset, on_progress) -> str:
+    """Derives the asset's proxy and renditions as cheaply as its probe data allows; returns the action."""
+    processed = crud.find_processed_asset(db, asset.content_hash) if asset.content_hash else None
+    if processed and processed.id != asset.id:
+        for field in crud.DERIVED_FIELDS:
+            setattr(asset, field, getattr(processed, field))
+        return "shared"
+
+    master = asset.master_path
+    action, reason = proxy_policy.decide(asset.asset_type, master, media.probe(db, master))
+    logger.info(f"Proxy for asset {asset.id}: {action} ({reason})")
+
+    if action == proxy_policy.IMAGE:
+        proxy = storage.proxy_path(master, ".jpg")
+        tasks.create_still_proxy(master, proxy)
+        asset.proxy_path = asset.poster_path = proxy
+        return action
+    if action == proxy_policy.SKIP and asset.asset_type == "image":
+        asset.proxy_path = asset.poster_path = master
+        return action
+    if action == proxy_policy.NONE:
+        return action
+
+    renditions = storage.rendition_paths(master)
+    if not asset.duration:
+        # Filmstrip tiles are spaced by duration
+        renditions.pop("filmstrip_path", None)
+    if action == proxy_policy.ENCODE:
+        proxy = storage.proxy_path(master)
+    else:
+        # The master is already proxy-sized, so it doubles as the scrub proxy
+        renditions.pop("scrub_proxy_path")
+        asset.scrub_proxy_path = master
+        proxy = None if action == proxy_policy.SKIP else storage.proxy_path(master)
+    tasks.create_proxy(
+        master,
+        proxy,
+        on_progress=on_progress,
+        duration=asset.duration,
+        remux=action == proxy_policy.REMUX,
+        scrub_path=renditions.get("scrub_proxy_path"),
+        poster_path=renditions.get("poster_path"),
+        filmstrip_path=renditions.get("filmstrip_path"),
+    )
+    proxy = proxy or master
+    if action == proxy_policy.REMUX:
+        asset.scrub_proxy_path = proxy
+    # Prime the probe cache so preview renders never probe the proxy.
+    media.probe(db, proxy)
+    asset.proxy_path = proxy
+    for field, path in renditions.items():
+        setattr(asset, field, path)
+    return action
+
+
+def _fill_missing_renditions(asset, on_progress) -> str:
+    """Writes the renditions an asset still lacks (e.g. after a streaming upload), decoding its small proxy."""
+    renditions = {
+        field: path for field, path in storage.rendition_paths(asset.master_path).items()
+        if not getattr(asset, field)
+    }
+    if not asset.duration:
+        # Filmstrip tiles are spaced by duration
+        renditions.pop("filmstrip_path", None)
+    tasks.create_proxy(
+        asset.proxy_path,
+        None,
+        on_progress=on_progress,
+        duration=asset.duration,
+        scrub_path=renditions.get("scrub_proxy_path"),
+        poster_path=renditions.get("poster_path"),
+        filmstrip_path=renditions.get("filmstrip_path"),
+    )
+    for field, path in renditions.items():
+        setattr(asset, field, path)
+    return "filled"
+
+
+def _with_render_output(payload: Dict, output_paths: List[str], public_urls: List[str]) -> Dict:
+    """Records where a render wrote its outputs so memoized lookups can verify them later."""
+    payload = dict(payload)
+    payload["outputs"] = [
+        {"path": str(path), "fingerprint": storage.file_fingerprint(path), "url": url}
+        for path, url in zip(output_paths, public_urls)
+    ]
+    payload["output_path"] = payload["outputs"][0]["path"]
+    payload["output_fingerprint"] = payload["outputs"][0]["fingerprint"]
+    return payload
+
+
+def _requeue_waiting_proxies(db: Session, content_hash: str, failed_assets: List[str]):
+    """
+    Queues a proxy job for other assets of this content after the job holding its claim failed.
+
+    Those assets were uploaded while the failed job was running and have no job of their own;
+    they would otherwise never get a proxy. The new job does not include ``failed_assets``, so a
+    source that cannot be processed is retried once for the waiting assets, not indefinitely.
+    """
+    waiting = crud.assets_waiting_for_proxy(db, content_hash, failed_assets)
+    if not waiting:
+        return
+    job = crud.create_job(
+        db, type="proxy", payload={"assets": [asset.id for asset in waiting]}, project_id=waiting[0].project_id
+    )
+    crud.claim_blob_proxy(db, content_hash, job.id)
+    enqueue_job(job.id)
+    logger.info(f"Requeued proxy job {job.id} for {len(waiting)} asset(s) waiting on content {content_hash}")
 
-    db: Session = SessionLocal()
-    try:
-        pending = (
-            db.query(models.Job)
-            .filter(models.Job.status.in_(["queued", "waiting", "running"]))
-            .order_by(models.Job.created_at.asc())
-            .all()
-        )
-        for job in pending:
-            if job.type == "hailuo-transition" and (job.remote_job_id or (job.payload and "hailuo_job_set_id" in (json.loads(job.payload or "{}") or {}))):
-                _enqueue_hailuo_poll(job.id)
-            job_q.put(job.id)
-    finally:
-        db.close()
 
+def _queue_error_backoff(failures: int) -> int:
+    """Waits after a failed queue operation, doubling the delay per failure; returns the new count."""
+    delay = min(_QUEUE_RETRY_MAX_DELAY, JOB_POLL_INTERVAL * 2 ** failures)
+    _stopping.wait(delay)
+    return failures + 1
 
-def worker_loop():
-    while True:
-        job_id = job_q.get()
+
+def _finish_claim(job_id: str, interrupted: bool):
+    """
+    Hands a job's queue entry back (``interrupted``) or removes it.
+
+    A database error here is only logged: the lease then expires and the job is claimed again,
+    which skips it if it already finished.
+    """
+    try:
+        if interrupted:
+            jobqueue.release(job_id)
+        else:
+            jobqueue.complete(job_id)
+    except Exception:
+        logger.exception(f"Could not update the queue entry of job {job_id}")
+
+
+def worker_loop(min_priority: Optional[int] = None):
+    """
+    Runs jobs from the queue; ``min_priority`` reserves the thread for high-priority lanes.
+
+    Queue errors (e.g. the database briefly unreachable) are logged and retried with backoff
+    instead of ending the thread.
+    """
+    failures = 0
+    while not _stopping.is_set():
+        try:
+            job_id = jobqueue.claim(jobqueue.JOBS, min_priority=min_priority)
+            if not job_id:
+                jobqueue.wait_for_work(jobqueue.JOBS)
+                failures = 0
+                continue
+        except Exception:
+            logger.exception("Claiming a job failed, retrying")
+            failures = _queue_error_backoff(failures)
+            continue
+        failures = 0
+        job = None
+        handed_off = False
+        interrupted = False
         db: Session = SessionLocal()
         try:
             job = crud.get_job(db, job_id)
             if not job or job.status not in ["queued", "waiting", "running"]:
-                db.close()
-                job_q.task_done()
                 continue
 
             crud.update_job(db, job.id, status="running")
@@ -162,71 +304,112 @@ def worker_loop():
             if job.type == "proxy":
                 assets = payload.get("assets", [])
                 total = max(len(assets), 1)
+                reporter = ProgressReporter(job.id)
+                asset_fractions = {aid: 0.0 for aid in assets}
+                fractions_lock = threading.Lock()
+                claimed_hashes = set()
+
+                def _asset_progress(aid: str, fraction: float):
+                    with fractions_lock:
+                        asset_fractions[aid] = fraction
+                        overall = sum(asset_fractions.values()) / total
+                    reporter.fraction(overall)
 
                 def _process_proxy(aid: str):
                     local_db: Session = SessionLocal()
+                    claimed_hash = None
                     try:
                         asset = crud.get_asset(local_db, aid)
                         if not asset:
-                            return False
-                        master = asset.master_path
-                        proxy = master.replace("/assets/", "/assets/proxy_")
-                        tasks.create_proxy(master, proxy)
-                        asset.proxy_path = proxy
+                            return None
+                        if asset.content_hash:
+                            with fractions_lock:
+                                duplicate = asset.content_hash in claimed_hashes
+                                claimed_hashes.add(asset.content_hash)
+                            if duplicate or not crud.claim_blob_proxy(local_db, asset.content_hash, job.id):
+                                # Another asset or job is writing this content's files and shares them when done
+                                return "pending"
+                            claimed_hash = asset.content_hash
+                        on_progress = lambda fraction: _asset_progress(aid, fraction)
+                        if payload.get("missing_only") and asset.proxy_path:
+                            action = _fill_missing_renditions(asset, on_progress)
+                        else:
+                            action = _generate_proxies(local_db, asset, on_progress)
                         local_db.add(asset)
                         local_db.commit()
-                        return True
+                        # Other uploads of the same content share the files
+                        crud.share_derived_files(local_db, asset)
+                        return action
+                    except Exception:
+                        if claimed_hash:
+                            crud.release_blob_proxy(local_db, claimed_hash, job.id)
+                            claimed_hash = None
+                            _requeue_waiting_proxies(local_db, asset.content_hash, assets)
+                        raise
                     finally:
+                        if claimed_hash:
+                            crud.release_blob_proxy(local_db, claimed_hash, job.id)
                         local_db.close()
 
-                with concurrent.futures.ThreadPoolExecutor(max_workers=min(4, len(assets) or 1)) as executor:
-                    completed = 0
-                    for success in executor.map(_process_proxy, assets):
-                        completed += 1
-                        progress = int((completed / total) * 100)
-                        crud.update_job(db, job.id, progress=progress)
+                with concurrent.futures.ThreadPoolExecutor(max_workers=min(cpu_budget.max_processes, len(assets) or 1)) as executor:
+                    actions = {}
+                    for aid, action in zip(assets, executor.map(_process_proxy, assets)):
+                        actions[aid] = action
+                        _asset_progress(aid, 1.0)
 
-                crud.update_job(db, job.id, status="completed", progress=100)
+                crud.update_job(db, job.id, status="completed", progress=100, payload={**payload, "actions": actions})
 
             elif job.type == "render":
-                command, output_path = render.build_ffmpeg_command(db, payload, job.id, preview=False)
-                logs = render.run_ffmpeg_render(command, job.id)
-                public_url = _publish_render(Path(output_path))
-                crud.update_job(db, job.id, status="completed", progress=100, result_path=public_url, logs=logs)
+                output_paths, logs = render.render_segmented(
+                    db,
+                    payload,
+                    job.id,
+                    on_progress=ProgressReporter(job.id),
+                )
+                # The upload to R2 needs no CPU slot; the IO executor publishes and completes the job
+                executors.io.submit(_run_io_stage, job.id, _publish_renders, output_paths, logs)
+                handed_off = True
+                continue
 
             elif job.type == "preview-render":
-                command, output_path = render.build_ffmpeg_command(db, payload, job.id, preview=True)
-                logs = render.run_ffmpeg_render(command, job.id)
-                public_url = _publish_render(Path(output_path))
-                crud.update_job(db, job.id, status="completed", progress=100, result_path=public_url, logs=logs)
+                streaming = PREVIEW_FORMAT == "hls"
+                if streaming:
+                    # The playlist is served while ffmpeg appends to it, so expose it right away
+                    crud.update_job(db, job.id, result_path=_preview_stream_url(job.id))
+                output_path, logs = render.render_chunked(
+                    db,
+                    payload,
+                    job.id,
+                    preview=True,
+                    on_progress=ProgressReporter(job.id),
+                )
+                if not streaming:
+                    executors.io.submit(_run_io_stage, job.id, _publish_renders, [output_path], logs)
+                    handed_off = True
+                    continue
+                public_url = _preview_stream_url(job.id)
+                crud.update_job(
+                    db,
+                    job.id,
+                    status="completed",
+                    progress=100,
+                    result_path=public_url,
+                    logs=logs,
+                    payload=_with_render_output(payload, [output_path], [public_url]),
+                )
             
             elif job.type == "higgsfield-generate":
-                # Example of a generative task
-                # 1. Get input asset URL (requires serving files or pre-uploading)
-                # 2. Call higgsfield API
-                # 3. Download result and create a new asset
-                # This is a simplified async-in-sync call.
-                # A real implementation might need polling.
-                import asyncio
-                input_url = payload.get("input_url") # e.g. http://host.docker.internal:8000/files/assets/....
-                params = payload.get("params", {})
-                result = asyncio.run(higgsfield.call_higgsfield_generate(input_url, params))
-                # Assume result is {'status':'done','result_url': '...'}
-                # TODO: download result_url, save as new asset, update job with asset_id
-                crud.update_job(db, job.id, status="completed", progress=100, payload={"result": result})
+                # Nothing here needs a CPU slot; the API call runs on the IO executor
+                executors.io.submit(_run_io_stage, job.id, _generate_higgsfield)
+                handed_off = True
+                continue
 
             elif job.type == "hailuo-transition":
                 from_asset_id = payload.get("from_asset_id")
                 to_asset_id = payload.get("to_asset_id")
-                prompt = payload.get("prompt") or "Seamless cinematic cut"
                 motion_id = payload.get("motion_id")
-                duration = int(payload.get("duration") or HAILUO_DEFAULT_DURATION)
-                resolution = str(payload.get("resolution") or "768")
-                enhance_prompt = bool(payload.get("enhance_prompt", True))
-                hailuo_request = payload.get("hailuo_request")
                 job_set_id = job.remote_job_id or payload.get("hailuo_job_set_id")
-                start_frame_path = end_frame_path = None
-                cleanup_start = cleanup_end = False
+                frames = None
 
                 if not motion_id:
                     raise ValueError("Hailuo transition requires motion_id")
@@ -249,51 +432,127 @@ def worker_loop():
                     if not from_asset or not to_asset:
                         raise ValueError("Missing source assets for Hailuo transition")
 
-                    if not hailuo_request:
-                        start_frame_path, cleanup_start = _prepare_frame(job.id, from_asset, start=True)
-                        end_frame_path, cleanup_end = _prepare_frame(job.id, to_asset, start=False)
-
-                        start_url = _publish_frame(start_frame_path)
-                        end_url = _publish_frame(end_frame_path)
-
-                        hailuo_request = {
-                            "start_image_url": start_url,
-                            "end_image_url": end_url,
-                            "prompt": prompt,
-                            "duration": duration,
-                            "motion_id": motion_id,
-                            "resolution": resolution,
-                            "enhance_prompt": enhance_prompt,
-                        }
-                        payload["hailuo_request"] = hailuo_request
-
-                    start_response = hailuo.start_transition(**hailuo_request)
-                    job_set_id = start_response.get("job_set_id")
-                    payload["hailuo_job_set_id"] = job_set_id
-                    crud.update_job(
-                        db,
-                        job.id,
-                        status="waiting",
-                        payload=payload,
-                        remote_job_id=job_set_id,
-                        logs=json.dumps({"hailuo_request": hailuo_request, "hailuo_response": start_response}),
-                    )
-                else:
-                    crud.update_job(db, job.id, status="waiting", payload=payload, remote_job_id=job_set_id)
-
-                _enqueue_hailuo_poll(job.id)
+                    if not payload.get("hailuo_request"):
+                        # CPU stage: extract the frames here, publish them from the IO executor
+                        start_frame_path, _ = _prepare_frame(job.id, from_asset, start=True)
+                        end_frame_path, _ = _prepare_frame(job.id, to_asset, start=False)
+                        frames = (start_frame_path, end_frame_path)
+
+                executors.io.submit(_run_io_stage, job.id, _start_hailuo_transition, frames)
+                handed_off = True
                 continue
 
             else:
                 crud.update_job(db, job.id, status="failed", logs=f"unknown job type: {job.type}")
 
         except Exception as e:
+            if _stopping.is_set():
+                # Its ffmpeg was stopped by the shutdown, not by a problem with the job
+                interrupted = True
+                logger.info(f"Job {job_id} interrupted by shutdown, handing it back to the queue")
+                continue
             error_log = {"error": str(e)}
+            log_tail = joblog.close_log(job_id)
+            if log_tail:
+                error_log["log_tail"] = log_tail
             if job:
-                crud.update_job(db, job.id, status="failed", logs=json.dumps(error_log))
+                try:
+                    crud.update_job(db, job.id, status="failed", logs=json.dumps(error_log))
+                except Exception:
+                    logger.exception(f"Could not mark job {job_id} as failed")
         finally:
             db.close()
-            job_q.task_done()
+            render.remove_work_dir(job_id)
+            if interrupted or not handed_off:
+                joblog.close_log(job_id)
+                _finish_claim(job_id, interrupted)
+
+
+def _run_io_stage(job_id: str, stage, *args):
+    """
+    Runs a job's network-bound stage on the IO executor, then finishes the job like worker_loop.
+
+    The job's queue lease stays held (and heartbeated) until the stage is done. A stage that
+    requeued the job returns True: the entry may already be claimed again by this process, so
+    completing it here would delete the new claim.
+    """
+    handed_off = False
+    db: Session = SessionLocal()
+    try:
+        job = crud.get_job(db, job_id)
+        handed_off = bool(stage(db, job, json.loads(job.payload or "{}"), *args))
+    except Exception as e:
+        crud.update_job(db, job_id, status="failed", logs=json.dumps({"error": str(e)}))
+    finally:
+        db.close()
+        joblog.close_log(job_id)
+        if not handed_off:
+            jobqueue.complete(job_id)
+
+
+def _publish_renders(db: Session, job, payload: Dict, output_paths: List[str], logs: str):
+    """IO stage of a render: publish the rendered files, then complete the job with their URLs."""
+    public_urls = [_publish_render(Path(path)) for path in output_paths]
+    crud.update_job(
+        db,
+        job.id,
+        status="completed",
+        progress=100,
+        result_path=public_urls[0],
+        logs=logs,
+        payload=_with_render_output(payload, output_paths, public_urls),
+    )
+
+
+def _generate_higgsfield(db: Session, job, payload: Dict):
+    # Example of a generative task
+    # 1. Get input asset URL (requires serving files or pre-uploading)
+    # 2. Call higgsfield API
+    # 3. Download result and create a new asset
+    # A real implementation might need polling.
+    input_url = payload.get("input_url") # e.g. http://host.docker.internal:8000/files/assets/....
+    params = payload.get("params", {})
+    result = executors.io.run_coroutine(higgsfield.call_higgsfield_generate(input_url, params))
+    # Assume result is {'status':'done','result_url': '...'}
+    # TODO: download result_url, save as new asset, update job with asset_id
+    crud.update_job(db, job.id, status="completed", progress=100, payload={"result": result})
+
+
+def _start_hailuo_transition(db: Session, job, payload: Dict, frames):
+    """IO stage of a Hailuo transition: publish the frames, start the remote job, hand it to the poller."""
+    hailuo_request = payload.get("hailuo_request")
+    job_set_id = job.remote_job_id or payload.get("hailuo_job_set_id")
+
+    if not job_set_id:
+        if not hailuo_request:
+            start_frame_path, end_frame_path = frames
+            hailuo_request = {
+                "start_image_url": _publish_frame(start_frame_path),
+                "end_image_url": _publish_frame(end_frame_path),
+                "prompt": payload.get("prompt") or "Seamless cinematic cut",
+                "duration": int(payload.get("duration") or HAILUO_DEFAULT_DURATION),
+                "motion_id": payload.get("motion_id"),
+                "resolution": str(payload.get("resolution") or "768"),
+                "enhance_prompt": bool(payload.get("enhance_prompt", True)),
+            }
+            payload["hailuo_request"] = hailuo_request
+
+        start_response = hailuo.start_transition(**hailuo_request)
+        job_set_id = start_response.get("job_set_id")
+        payload["hailuo_job_set_id"] = job_set_id
+        crud.update_job(
+            db,
+            job.id,
+            status="waiting",
+            payload=payload,
+            remote_job_id=job_set_id,
+            logs=json.dumps({"hailuo_request": hailuo_request, "hailuo_response": start_response}),
+        )
+    else:
+        crud.update_job(db, job.id, status="waiting", payload=payload, remote_job_id=job_set_id)
+
+    _enqueue_hailuo_poll(job.id)
+    return True
 
 
 def _complete_hailuo_transition(
@@ -315,7 +574,7 @@ def _complete_hailuo_transition(
             resp.raise_for_status()
             output_path.write_bytes(resp.content)
 
-    media_info = tasks.probe_media(str(output_path))
+    media_info = media.probe(db, str(output_path))
 
     new_asset = crud.create_asset(
         db,
@@ -344,93 +603,182 @@ def _complete_hailuo_transition(
 
 
 def hailuo_poll_loop():
-    while True:
-        job_id = hailuo_poll_q.get()
-        db: Session = SessionLocal()
+    """
+    Hands Hailuo jobs that wait on the remote API to the poll executor.
+
+    Each poll blocks for up to HAILUO_TIMEOUT, so polls get their own HAILUO_POLL_THREADS
+    threads; on the IO executor they could fill every thread while R2 uploads and Hailuo
+    starts queue behind them, holding their leases. Claim errors are retried with backoff, as
+    in ``worker_loop``.
+    """
+    slots = threading.BoundedSemaphore(executors.polls.max_workers)
+    failures = 0
+    while not _stopping.is_set():
+        slots.acquire()
         try:
-            job = crud.get_job(db, job_id)
-            if not job:
+            job_id = jobqueue.claim(jobqueue.HAILUO_POLL)
+            if not job_id:
+                slots.release()
+                jobqueue.wait_for_work(jobqueue.HAILUO_POLL)
+                failures = 0
                 continue
+        except Exception:
+            slots.release()
+            logger.exception("Claiming a Hailuo poll failed, retrying")
+            failures = _queue_error_backoff(failures)
+            continue
+        failures = 0
+        try:
+            future = executors.polls.submit(_poll_hailuo_job, job_id)
+        except RuntimeError:
+            # The executor is shutting down; the poll is picked up again after a restart
+            slots.release()
+            _finish_claim(job_id, interrupted=True)
+            continue
+        future.add_done_callback(lambda _future: slots.release())
 
-            payload = json.loads(job.payload or "{}")
-            job_set_id = job.remote_job_id or payload.get("hailuo_job_set_id")
-            hailuo_request = payload.get("hailuo_request") or {}
-
-            if payload.get("asset_id"):
-                asset = crud.get_asset(db, payload["asset_id"])
-                if asset and Path(asset.master_path).exists():
-                    crud.update_job(
-                        db,
-                        job.id,
-                        status="completed",
-                        progress=100,
-                        result_path=asset.master_path,
-                    )
-                    continue
 
-            if not job_set_id:
-                continue
+def _poll_hailuo_job(job_id: str):
+    requeued = False
+    db: Session = SessionLocal()
+    try:
+        job = crud.get_job(db, job_id)
+        if not job:
+            return
 
-            try:
-                result = hailuo.poll_existing_job(
-                    job_set_id,
-                    poll_interval=HAILUO_POLL_INTERVAL,
-                    timeout=HAILUO_TIMEOUT,
-                    max_polls=HAILUO_MAX_POLLS,
-                )
-            except hailuo.HailuoError as exc:
-                message = str(exc).lower()
-                status_to_set = "failed"
-                if any(token in message for token in ("timed out", "maximum poll", "client has been closed")):
-                    status_to_set = "waiting"
+        payload = json.loads(job.payload or "{}")
+        job_set_id = job.remote_job_id or payload.get("hailuo_job_set_id")
+        hailuo_request = payload.get("hailuo_request") or {}
+
+        if payload.get("asset_id"):
+            asset = crud.get_asset(db, payload["asset_id"])
+            if asset and Path(asset.master_path).exists():
                 crud.update_job(
                     db,
                     job.id,
-                    status=status_to_set,
-                    logs=json.dumps({
-                        "error": str(exc),
-                        "hailuo_job_set_id": job_set_id,
-                        "hailuo_request": hailuo_request,
-                    }),
-                    remote_job_id=job_set_id,
-                    payload=payload,
+                    status="completed",
+                    progress=100,
+                    result_path=asset.master_path,
                 )
-                if status_to_set == "waiting":
-                    time.sleep(max(1.0, HAILUO_POLL_INTERVAL))
-                    _enqueue_hailuo_poll(job.id)
-                continue
+                return
 
-            result_url = result.get("result_url")
-            if not result_url:
-                raise RuntimeError("Hailuo did not return a downloadable result URL")
+        if not job_set_id:
+            return
 
-            _complete_hailuo_transition(
+        try:
+            result = hailuo.poll_existing_job(
+                job_set_id,
+                poll_interval=HAILUO_POLL_INTERVAL,
+                timeout=HAILUO_TIMEOUT,
+                max_polls=HAILUO_MAX_POLLS,
+            )
+        except hailuo.HailuoError as exc:
+            message = str(exc).lower()
+            status_to_set = "failed"
+            if any(token in message for token in ("timed out", "maximum poll", "client has been closed")):
+                status_to_set = "waiting"
+            crud.update_job(
                 db,
-                job=job,
+                job.id,
+                status=status_to_set,
+                logs=json.dumps({
+                    "error": str(exc),
+                    "hailuo_job_set_id": job_set_id,
+                    "hailuo_request": hailuo_request,
+                }),
+                remote_job_id=job_set_id,
                 payload=payload,
-                job_set_id=job_set_id,
-                hailuo_request=hailuo_request,
-                result_url=result_url,
             )
+            if status_to_set == "waiting":
+                _enqueue_hailuo_poll(job.id, delay=max(1.0, HAILUO_POLL_INTERVAL))
+                requeued = True
+            return
+
+        result_url = result.get("result_url")
+        if not result_url:
+            raise RuntimeError("Hailuo did not return a downloadable result URL")
+
+        _complete_hailuo_transition(
+            db,
+            job=job,
+            payload=payload,
+            job_set_id=job_set_id,
+            hailuo_request=hailuo_request,
+            result_url=result_url,
+        )
+
+    except Exception as exc:
+        if job_id:
+            crud.update_job(
+                db,
+                job_id,
+                status="failed",
+                logs=json.dumps({"error": str(exc)}),
+            )
+    finally:
+        db.close()
+        if not requeued:
+            jobqueue.complete(job_id)
 
-        except Exception as exc:
-            if job_id:
-                crud.update_job(
-                    db,
-                    job_id,
-                    status="failed",
-                    logs=json.dumps({"error": str(exc)}),
-                )
-        finally:
-            db.close()
-            hailuo_poll_q.task_done()
 
 def start_worker_thread():
-    from .config import WORKER_THREADS
-    _restore_pending_jobs()
+    from .config import WORKER_THREADS, PREVIEW_WORKER_THREADS, JOB_PRIORITIES
+    jobqueue.restore_unqueued_jobs()
     for i in range(WORKER_THREADS):
-        t = threading.Thread(target=worker_loop, daemon=True, name=f"Worker-{i}")
+        _threads.append(threading.Thread(target=worker_loop, daemon=True, name=f"Worker-{i}"))
+    for i in range(PREVIEW_WORKER_THREADS):
+        _threads.append(threading.Thread(
+            target=worker_loop,
+            kwargs={"min_priority": JOB_PRIORITIES["preview-render"]},
+            daemon=True,
+            name=f"PreviewWorker-{i}",
+        ))
+    _threads.append(threading.Thread(target=hailuo_poll_loop, daemon=True, name="HailuoPoller"))
+    for t in _threads:
         t.start()
-    polling_threads = max(1, min(2, WORKER_THREADS))
-    for i in range(polling_threads):
-        threading.Thread(target=hailuo_poll_loop, daemon=True, name=f"HailuoPoller-{i}").start()
+
+
+def stop_workers(timeout: float = WORKER_SHUTDOWN_TIMEOUT):
+    """
+    Stops this process's workers without running any job twice.
+
+    Claiming stops and running ffmpeg processes are terminated, so their jobs go back to the
+    queue at once. Network stages (a Hailuo start, an R2 upload) can't be stopped safely and
+    get up to ``timeout`` seconds to finish; any still running keep their leases, so another
+    worker only takes them over once the lease expires.
+    """
+    _stopping.set()
+    cpu_budget.terminate_all()
+    deadline = time.monotonic() + timeout
+    for t in _threads:
+        t.join(max(0.0, deadline - time.monotonic()))
+    running = executors.io.wait(max(0.0, deadline - time.monotonic()))
+    if running:
+        logger.warning(f"{running} network stages still running; their jobs wait for the lease to expire")
+
+
+def main():
+    """
+    Standalone worker process: ``python -m app.worker``.
+
+    Any number of these can run, on any host sharing DATABASE_URL and the storage directory;
+    jobs are handed out through the durable queue. Set EMBEDDED_WORKER=false on the API so
+    it only enqueues.
+    """
+    import signal
+
+    STORAGE_DIR.mkdir(parents=True, exist_ok=True)
+    init_db()
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    start_worker_thread()
+    logger.info(f"Worker {jobqueue.WORKER_ID} started")
+    stop.wait()
+    stop_workers()
+    logger.info(f"Worker {jobqueue.WORKER_ID} stopped")
+
+
+if __name__ == "__main__":
+    main()
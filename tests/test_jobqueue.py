@@ -0,0 +1,174 @@
+import concurrent.futures
+import os
+import tempfile
+import time
+
+# The app reads its configuration at import time, so point it at a scratch database first
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/test.db"
+
+import pytest
+from sqlalchemy import delete, update
+
+from app import crud, jobqueue, models
+from app.db import SessionLocal, init_db
+
+
+@pytest.fixture(autouse=True)
+def clean_queue():
+    init_db()
+    yield
+    db = SessionLocal()
+    try:
+        db.execute(delete(models.QueueEntry))
+        db.execute(delete(models.Job))
+        db.execute(delete(models.ProjectShare))
+        db.commit()
+    finally:
+        db.close()
+    jobqueue._held.clear()
+
+
+def _queued_job(job_type: str = "render", project_id: str = None) -> str:
+    db = SessionLocal()
+    try:
+        job_id = crud.create_job(db, type=job_type, payload={}, project_id=project_id).id
+    finally:
+        db.close()
+    assert jobqueue.enqueue(job_id)
+    return job_id
+
+
+def _entry(job_id: str):
+    db = SessionLocal()
+    try:
+        return db.get(models.QueueEntry, job_id)
+    finally:
+        db.close()
+
+
+def _expire_lease(job_id: str):
+    """What the queue sees once the worker holding the job died and stopped heartbeating."""
+    db = SessionLocal()
+    try:
+        db.execute(update(models.QueueEntry).where(models.QueueEntry.job_id == job_id).values(lease_expires_at=0))
+        db.commit()
+    finally:
+        db.close()
+
+
+def test_enqueue_twice_keeps_one_entry():
+    job_id = _queued_job()
+    assert not jobqueue.enqueue(job_id)
+
+
+def test_leased_job_is_not_claimed_twice():
+    job_id = _queued_job()
+    assert jobqueue.claim(jobqueue.JOBS) == job_id
+    assert jobqueue.claim(jobqueue.JOBS) is None
+
+
+def test_concurrent_claims_never_share_a_job():
+    job_ids = {_queued_job() for _ in range(10)}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        claimed = list(executor.map(lambda _: jobqueue.claim(jobqueue.JOBS), range(20)))
+    won = [job_id for job_id in claimed if job_id]
+    assert len(won) == len(set(won))
+    assert set(won) == job_ids
+
+
+def test_expired_lease_is_claimed_again():
+    job_id = _queued_job()
+    assert jobqueue.claim(jobqueue.JOBS) == job_id
+    _expire_lease(job_id)
+    assert jobqueue.claim(jobqueue.JOBS) == job_id
+    assert _entry(job_id).attempts == 2
+
+
+def test_job_fails_after_max_attempts():
+    job_id = _queued_job()
+    for _ in range(jobqueue.JOB_MAX_ATTEMPTS):
+        assert jobqueue.claim(jobqueue.JOBS) == job_id
+        _expire_lease(job_id)
+    assert jobqueue.claim(jobqueue.JOBS) is None
+    assert _entry(job_id) is None
+    db = SessionLocal()
+    try:
+        assert crud.get_job(db, job_id).status == "failed"
+    finally:
+        db.close()
+
+
+def test_requeue_resets_attempts_and_moves_queue():
+    job_id = _queued_job("hailuo-transition")
+    assert jobqueue.claim(jobqueue.JOBS) == job_id
+    jobqueue.requeue(job_id, jobqueue.HAILUO_POLL)
+    assert jobqueue.claim(jobqueue.JOBS) is None
+    assert jobqueue.claim(jobqueue.HAILUO_POLL) == job_id
+    assert _entry(job_id).attempts == 1
+
+
+def test_release_does_not_count_an_attempt():
+    job_id = _queued_job()
+    assert jobqueue.claim(jobqueue.JOBS) == job_id
+    jobqueue.release(job_id)
+    assert jobqueue.claim(jobqueue.JOBS) == job_id
+    assert _entry(job_id).attempts == 1
+
+
+def test_complete_leaves_a_lost_lease_alone():
+    job_id = _queued_job()
+    assert jobqueue.claim(jobqueue.JOBS) == job_id
+    db = SessionLocal()
+    try:
+        # Another worker claimed the job after this process's lease expired
+        db.execute(
+            update(models.QueueEntry).where(models.QueueEntry.job_id == job_id).values(lease_owner="other-worker")
+        )
+        db.commit()
+    finally:
+        db.close()
+    jobqueue.complete(job_id)
+    assert _entry(job_id) is not None
+
+
+def test_project_cap_ignores_previews(monkeypatch):
+    monkeypatch.setattr(jobqueue, "PROJECT_MAX_RUNNING", 1)
+    preview_id = _queued_job("preview-render", project_id="capped")
+    render_id = _queued_job("render", project_id="capped")
+    assert jobqueue.claim(jobqueue.JOBS) == preview_id
+    assert jobqueue.claim(jobqueue.JOBS) == render_id
+    _queued_job("render", project_id="capped")
+    assert jobqueue.claim(jobqueue.JOBS) is None
+
+
+def test_idle_project_starts_at_the_front(monkeypatch):
+    monkeypatch.setattr(jobqueue, "JOB_FAIR_SHARE_QUANTUM", 1000.0)
+    for _ in range(3):
+        job_id = _queued_job(project_id="bursty")
+        assert jobqueue.claim(jobqueue.JOBS) == job_id
+        jobqueue.complete(job_id)
+    assert _entry(_queued_job(project_id="bursty")).virtual_start < time.time() + 1
+
+
+def test_worker_loop_survives_claim_errors(monkeypatch):
+    from sqlalchemy.exc import OperationalError
+
+    from app import worker
+
+    calls = []
+
+    def flaky_claim(queue, min_priority=None):
+        calls.append(queue)
+        if len(calls) == 1:
+            raise OperationalError("SELECT 1", {}, Exception("database is locked"))
+        worker._stopping.set()
+        return None
+
+    monkeypatch.setattr(jobqueue, "claim", flaky_claim)
+    monkeypatch.setattr(jobqueue, "wait_for_work", lambda queue: None)
+    monkeypatch.setattr(worker, "JOB_POLL_INTERVAL", 0.01)
+    try:
+        worker.worker_loop()
+    finally:
+        worker._stopping.clear()
+    assert len(calls) == 2